@@ -0,0 +1,291 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI benchmarks
+
+Replays synthetic or recorded event streams through the transcoder paths using virtual devices, and reports
+messages/sec, the per-event latency distribution and the memory allocated per event. Runs headless:
+
+    python -m benchmarks.bench [--events 100000] [--stream recorded.json] [--only name] [--json results.json]
+
+A recorded stream is a JSON list of PortMidi events [[status, data1, data2, 0], timestamp].
+
+B/event alloc is the memory allocated per event, temporaries included, measured with tracemalloc by an
+AllocationProbe (benchmarks/virtual.py) per step: a message, an input batch or a JACK period. The mean is over all
+events, the max is the step that allocated the most per event. A path without allocations shows 0 for both.
+blocks/event retained is the number of memory blocks allocated during the run and still alive after it, counted from
+tracemalloc snapshots before and after the run, divided by the number of events: state that grows with the stream.
+"""
+import argparse
+import contextlib
+import gc
+import importlib.util
+import json
+import os
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+
+from benchmarks.virtual import VirtualInput, VirtualOutput, VirtualJackClient, EndOfStream, AllocationProbe, \
+    install_virtual_jack
+from transcoder.utils.midi import TranscodeMap, InputMux, MessageBatch, NOTE_ON, NOTE_OFF
+from transcoder.utils.log import message_log, VERBOSITY_OFF
+
+install_virtual_jack()
+
+
+def drum_stream(num_events, seed=0):
+    """Band Hero drum hits on channel 9, a note on and note off per hit."""
+    rng = random.Random(seed)
+    pads = [16, 38, 48, 45, 46, 49]
+    events = []
+    for i in range(num_events // 2):
+        pad = rng.choice(pads)
+        events.append([[(NOTE_ON << 4) | 9, pad, rng.randrange(1, 128), 0], i * 2])
+        events.append([[(NOTE_OFF << 4) | 9, pad, 0, 0], i * 2 + 1])
+    return events
+
+
+def glissando_stream(num_events, channel=8, seed=0):
+    """Fast overlapping runs up and down the keyboard, note offs as velocity 0 NOTE_ON, with sustain pedal."""
+    rng = random.Random(seed)
+    events = []
+    held = []
+    note = 60
+    for i in range(num_events):
+        if i % 200 == 0:
+            events.append([[0xB0 | channel, 64, 127 if i % 400 == 0 else 0, 0], i])
+        elif len(held) > 3 or (held and rng.random() < 0.4):
+            events.append([[(NOTE_ON << 4) | channel, held.pop(0), 0, 0], i])
+        else:
+            note = min(max(note + rng.choice([-2, -1, 1, 2]), 21), 108)
+            held.append(note)
+            events.append([[(NOTE_ON << 4) | channel, note, rng.randrange(1, 128), 0], i])
+    return events
+
+
+def channel_stream(num_events, seed=0):
+    """Random channel messages of every kind on all channels, the stream of transcoder.utils.batch.benchmark."""
+    rng = random.Random(seed)
+    return [[[rng.randrange(0x80, 0xF0), rng.randrange(128), rng.randrange(128), 0], i] for i in range(num_events)]
+
+
+def load_stream(path):
+    with open(path) as f:
+        return [[list(message), timestamp] for message, timestamp in json.load(f)]
+
+
+def to_jack_events(events, frames_per_ms=48):
+    return [(timestamp * frames_per_ms, bytes(message[:3])) for message, timestamp in events]
+
+
+def run_transcode_message(events, probe=None):
+    from transcoder.transcode import transcode_message, BH_TO_VB
+    conv = TranscodeMap(BH_TO_VB)
+
+    def run():
+        if probe is None:
+            for message in events:
+                transcode_message(message, conv)
+            return
+        for message in events:
+            probe.begin()
+            transcode_message(message, conv)
+            probe.end(1)
+    return run, None
+
+
+def run_transcode_loop(events, probe=None):
+    from transcoder.transcode import message_transcode_loop, BH_TO_VB
+    midi_input = VirtualInput(events, probe=probe)
+    midi_output = VirtualOutput([midi_input])
+
+    def run():
+        with contextlib.suppress(EndOfStream):
+            message_transcode_loop(midi_input, midi_output, TranscodeMap(BH_TO_VB))
+    return run, midi_output
+
+
+def run_round_robin(events, probe=None):
+    from transcoder.transcode import round_robin_notes
+    midi_input = VirtualInput(events, probe=probe)
+    midi_output = VirtualOutput([midi_input])
+
+    def run():
+        with contextlib.suppress(EndOfStream):
+            round_robin_notes(midi_input, midi_output, in_channel=8, out_channels=[0, 1, 2, 3])
+    return run, midi_output
+
+
+def run_gui_forward(events, probe=None):
+    from transcoder.gui import Messages, HeadlessUI, make_routing
+    # Four layers: two split halves on channels 0 and 1, an octave up on 2 and everything on 3
+    routing = make_routing(inputs=0xFFFF, outputs=0b1111, thru=0xFFFF,
+                           split_begin=[0, 60, 0, 0] + [0] * 12, split_end=[60, 128, 128, 128] + [128] * 12,
+                           transpose=[0, 0, 1, 0] + [0] * 12, octave=True)
+    keyboard = VirtualInput(events, raise_at_end=False, probe=probe)  # the steps include the thru events
+    thru = VirtualInput(events[::4], raise_at_end=False)
+    messages = Messages(midi_thru_name="thru", midi_input_name="keyboard", midi_output_name="out",
+                        ui=HeadlessUI(routing))
+    messages.midi_output = VirtualOutput([keyboard, thru])
+    mux = InputMux([keyboard, thru])
+
+    def run():
+        while True:
+            batch = mux.read()
+            if not batch:
+                break
+            messages.forward(batch)
+    return run, messages.midi_output
+
+
+def run_volcafm(events, probe=None):
+    from volcafm_velo.volcafm_velo import make_process
+    client = VirtualJackClient("VolcaFM", probe=probe)
+    inport = client.midi_inports.register("in")
+    outport = client.midi_outports.register("out")
+    client.set_process_callback(make_process(inport, outport, use_fm=True))
+    jack_events = to_jack_events(events)
+
+    def run():
+        client.run_periods(jack_events)
+    return run, client
+
+
+def run_message_batch(events, probe=None):
+    from transcoder.utils.batch import benchmark_chain, run_chain_batch
+    batch = MessageBatch.from_events(events)
+    chain = benchmark_chain()
+
+    def run():
+        if probe is not None:
+            probe.begin()
+        run_chain_batch(batch, *chain)
+        if probe is not None:
+            probe.end(len(events))
+    return run, None
+
+
+def run_batch_vectorized(events, probe=None):
+    from transcoder.utils.batch import benchmark_chain, run_chain, from_batch
+    arrays = from_batch(MessageBatch.from_events(events))
+    chain = benchmark_chain()
+
+    def run():
+        if probe is not None:
+            probe.begin()
+        run_chain(*arrays, *chain)
+        if probe is not None:
+            probe.end(len(events))
+    return run, None
+
+
+SCENARIOS = {
+    "transcode_message": (run_transcode_message, drum_stream),
+    "message_transcode_loop": (run_transcode_loop, drum_stream),
+    "round_robin_notes": (run_round_robin, glissando_stream),
+    "gui_forward": (run_gui_forward, glissando_stream),
+    "volcafm_process": (run_volcafm, glissando_stream),
+    "message_batch": (run_message_batch, channel_stream),
+}
+if importlib.util.find_spec("numpy") is not None:  # NumPy is optional, it is only needed for the batch transforms
+    SCENARIOS["batch_vectorized"] = (run_batch_vectorized, channel_stream)
+
+
+def measure(name, make_run, events):
+    # Output of the paths that still print is discarded, the console would dominate the measurement
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        run, sink = make_run(events)
+        gc.collect()
+        start = perf_counter()
+        run()
+        elapsed = perf_counter() - start
+
+        probe = AllocationProbe()
+        run, _ = make_run(events, probe)
+        gc.collect()
+        gc.disable()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        probe.calibrate()
+        run()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        gc.enable()
+
+    # The snapshots themselves are traced too, leave out what tracemalloc allocated
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    blocks = sum(stat.count_diff for stat in after.filter_traces(filters).compare_to(before.filter_traces(filters),
+                                                                                      "filename"))
+    result = {"name": name, "events": len(events), "seconds": elapsed, "events_per_sec": len(events) / elapsed,
+              "alloc_bytes_per_event": {"mean": probe.mean, "max": probe.max},
+              "retained_blocks_per_event": blocks / len(events)}
+    histogram = None
+    if isinstance(sink, VirtualOutput):
+        histogram = sink.latency_ns
+        result["written"] = sink.count
+        result["writes"] = sink.writes
+    elif isinstance(sink, VirtualJackClient):
+        histogram = sink.callback_ns
+        result["written"] = sum(port.count for port in sink.midi_outports.ports)
+    if histogram is not None and histogram.count:
+        result["latency_us"] = {"p50": histogram.percentile(50) / 1000, "p99": histogram.percentile(99) / 1000,
+                                "max": histogram.max / 1000}
+    return result
+
+
+def print_result(result):
+    alloc = result["alloc_bytes_per_event"]
+    line = (f"{result['name']:<24} {result['events_per_sec']:>12,.0f} msg/s "
+            f"{alloc['mean']:>7.1f} B/event alloc (max {alloc['max']:>6.0f}) "
+            f"{result['retained_blocks_per_event']:>6.3f} blocks/event retained")
+    if "latency_us" in result:
+        latency = result["latency_us"]
+        line += f"   latency us p50: {latency['p50']:.1f} p99: {latency['p99']:.1f} max: {latency['max']:.1f}"
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MIDI transcoder paths on virtual devices")
+    parser.add_argument("--events", type=int, default=100000, help="number of synthetic events per scenario")
+    parser.add_argument("--stream", help="replay a recorded JSON event stream instead of synthetic events")
+    parser.add_argument("--only", action="append", choices=list(SCENARIOS), help="run only these scenarios")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    message_log.set_verbosity(VERBOSITY_OFF)
+    # The loops read PortMidi's clock, which works without any MIDI devices present
+    import pygame.midi
+    pygame.midi.init()
+    recorded = load_stream(args.stream) if args.stream else None
+    results = []
+    for name, (make_run, make_stream) in SCENARIOS.items():
+        if args.only and name not in args.only:
+            continue
+        events = recorded if recorded is not None else make_stream(args.events)
+        result = measure(name, make_run, events)
+        print_result(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
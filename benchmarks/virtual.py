@@ -0,0 +1,279 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' virtual MIDI devices
+
+In-memory stand-ins for pygame.midi.Input/Output and for a JACK client, so the transcoder paths can be replayed and
+measured without hardware. Given an AllocationProbe they measure the memory allocated per batch or JACK period.
+"""
+import sys
+import tracemalloc
+import types
+from array import array
+from time import perf_counter_ns
+
+from transcoder.utils.stats import Histogram
+
+
+class AllocationProbe:
+    """
+    Memory allocated per step (a message, an input batch or a JACK period) while tracemalloc traces: the peak of the
+    traced memory during the step above the level at its start, so the temporaries freed within the step count too.
+    The results are kept in an array, which holds no objects, and begin() ends with reset_peak(). What the probe
+    itself still allocates, measured by calibrate() on empty steps, is subtracted.
+    """
+    def __init__(self):
+        # level at the start of the step, overhead, bytes, events, steps, max bytes per event of a step
+        self.state = array("d", bytes(6 * 8))
+        self.running = False
+
+    def begin(self):
+        self.state[0] = tracemalloc.get_traced_memory()[0]
+        self.running = True
+        tracemalloc.reset_peak()
+
+    def end(self, events):
+        """End the current step, which handled events events. Steps without events are not recorded."""
+        if not self.running:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        self.running = False
+        if events:
+            state = self.state
+            allocated = max(peak - state[0] - state[1], 0.0)
+            state[2] += allocated
+            state[3] += events
+            state[4] += 1
+            state[5] = max(state[5], allocated / events)
+
+    def calibrate(self, steps=100):
+        """Measure the overhead on empty steps and start counting from zero, tracemalloc must be tracing."""
+        self.state = array("d", bytes(6 * 8))
+        overhead = None
+        for _ in range(steps):
+            before = self.state[2]
+            self.begin()
+            self.end(1)
+            allocated = self.state[2] - before
+            overhead = allocated if overhead is None else min(overhead, allocated)
+        self.state = array("d", [0.0, overhead, 0.0, 0.0, 0.0, 0.0])
+
+    @property
+    def mean(self):
+        """Bytes allocated per event over all steps."""
+        return self.state[2] / self.state[3] if self.state[3] else 0.0
+
+    @property
+    def max(self):
+        """Bytes allocated per event of the step that allocated the most per event."""
+        return self.state[5]
+
+
+class EndOfStream(Exception):
+    """Raised by a VirtualInput when all events have been read, ends the (otherwise endless) transcoder loops."""
+
+
+class VirtualInput:
+    """
+    pygame.midi.Input replaying a list of PortMidi events ([[status, data1, data2, 0], timestamp]). With a probe a
+    step runs from the end of one read() to the start of the next, the handling of the batch read.
+    """
+    def __init__(self, events, raise_at_end=True, probe=None):
+        self.events = events
+        self.pos = 0
+        self.raise_at_end = raise_at_end
+        self.last_read_ns = 0
+        self.probe = probe
+        self.batch_size = 0
+
+    def poll(self):
+        if self.pos < len(self.events):
+            return True
+        if self.raise_at_end:
+            if self.probe is not None:
+                self.probe.end(self.batch_size)
+            raise EndOfStream()
+        return False
+
+    def read(self, num_events):
+        if self.probe is not None:
+            self.probe.end(self.batch_size)
+        batch = self.events[self.pos:self.pos + num_events]
+        self.pos += len(batch)
+        self.batch_size = len(batch)
+        self.last_read_ns = perf_counter_ns()
+        if self.probe is not None:
+            self.probe.begin()
+        return batch
+
+    def close(self):
+        pass
+
+
+class VirtualOutput:
+    """
+    pygame.midi.Output counting the written events. The latency of every event is the time between the last read()
+    of the given inputs and the write(), recorded in the latency_ns histogram.
+    """
+    def __init__(self, inputs=(), keep=False):
+        self.inputs = list(inputs)
+        self.keep = keep
+        self.written = []
+        self.count = 0
+        self.writes = 0
+        self.latency_ns = Histogram()
+
+    def write(self, events):
+        now = perf_counter_ns()
+        if self.inputs:
+            self.latency_ns.record(now - max(i.last_read_ns for i in self.inputs), len(events))
+        self.count += len(events)
+        self.writes += 1
+        if self.keep:
+            self.written.extend(events)
+
+    def write_short(self, status, data1=0, data2=0):
+        self.write([[[status, data1, data2, 0], 0]])
+
+    def close(self):
+        pass
+
+
+class VirtualJackInPort:
+    def __init__(self, name):
+        self.name = name
+        self.period_events = []
+
+    def incoming_midi_events(self):
+        return self.period_events
+
+
+class VirtualJackOutPort:
+    def __init__(self, name, keep=False):
+        self.name = name
+        self.keep = keep
+        self.events = []
+        self.count = 0
+        self.last_offset = 0
+
+    def clear_buffer(self):
+        self.last_offset = 0
+
+    def write_midi_event(self, offset, data):
+        if offset < self.last_offset:
+            raise ValueError(f"JACK MIDI events must be written in frame order ({offset} < {self.last_offset})")
+        self.last_offset = offset
+        self.count += 1
+        if self.keep:
+            self.events.append((offset, bytes(data)))
+
+
+class VirtualPorts:
+    def __init__(self, port_type):
+        self.port_type = port_type
+        self.ports = []
+
+    def register(self, name):
+        port = self.port_type(name)
+        self.ports.append(port)
+        return port
+
+
+class VirtualJackClient:
+    """
+    jack.Client stand-in. run_periods() slices a list of (frame, bytes) events into periods of blocksize frames,
+    hands every period to the registered in ports and calls the process callback, timing every callback. With a probe
+    every callback is a step.
+    """
+    def __init__(self, name, blocksize=64, samplerate=48000, probe=None, **kwargs):
+        self.name = name
+        self.blocksize = blocksize
+        self.samplerate = samplerate
+        self.midi_inports = VirtualPorts(VirtualJackInPort)
+        self.midi_outports = VirtualPorts(VirtualJackOutPort)
+        self.process_callback = None
+        self.xrun_callback = None
+        self.port_connect_callback = None
+        self.callback_ns = Histogram()
+        self.active = False
+        self.last_frame_time = 0
+        self.connections = []
+        self.probe = probe
+
+    @property
+    def frame_time(self):
+        return self.last_frame_time
+
+    def get_ports(self, name_pattern="", is_midi=False, is_input=False, is_output=False):
+        return []
+
+    def connect(self, source, destination):
+        self.connections.append((source, destination))
+
+    def set_process_callback(self, callback):
+        self.process_callback = callback
+        return callback
+
+    def set_xrun_callback(self, callback):
+        self.xrun_callback = callback
+        return callback
+
+    def set_port_connect_callback(self, callback, only_available=True):
+        self.port_connect_callback = callback
+        return callback
+
+    def activate(self):
+        self.active = True
+
+    def deactivate(self):
+        self.active = False
+
+    def close(self):
+        pass
+
+    def run_periods(self, events, ports=None):
+        """events are (absolute frame, bytes) in frame order, ports the in ports to feed (all when None)."""
+        ports = self.midi_inports.ports if ports is None else ports
+        pos = 0
+        period_start = 0
+        while pos < len(events):
+            period_end = period_start + self.blocksize
+            period = []
+            while pos < len(events) and events[pos][0] < period_end:
+                frame, data = events[pos]
+                period.append((frame - period_start, data))
+                pos += 1
+            for port in ports:
+                port.period_events = period
+            self.last_frame_time = period_start
+            if self.probe is not None:
+                self.probe.begin()
+            start = perf_counter_ns()
+            self.process_callback(self.blocksize)
+            elapsed = perf_counter_ns() - start
+            if self.probe is not None:
+                self.probe.end(len(period))
+            self.callback_ns.record(elapsed)
+            period_start = period_end
+
+
+def install_virtual_jack():
+    """Make `import jack` return a module whose Client is a VirtualJackClient."""
+    module = types.ModuleType("jack")
+    module.Client = VirtualJackClient
+    sys.modules["jack"] = module
+    return module
@@ -20,10 +20,10 @@ drClass' MIDI Markup Language (MML)
 1) Example
 """
 
-import midiutil
+from genmidi import smf
 from genmidi.main import create, add_notes
 
-mf = create(num=4, den=4, tempo=60, sign=midiutil.FLATS, scale=midiutil.MAJOR)
+mf = create(num=4, den=4, tempo=60, sign=smf.FLATS, scale=smf.MAJOR)
 
 add_notes(mf, 0, notes="[E5        |E, F, G   |E ,C       |         ]"
                        "[          |D, C      |Eb, Db     |C, Bb4   ]"
@@ -95,5 +95,5 @@ add_notes(mf, 1, notes=f"[{Fmaj7}|{Fmaj7}|{Dm7}   |{Dm7}   ]"
                        f"[{Gb7m5}|{Gb7m5}   |{C7}   |{C7}   ]"
           )
 
-with open("c:/projects/midi/Just for you.mid", 'wb') as f:
+with open("Just for you.mid", "wb") as f:
     mf.writeFile(f)
@@ -0,0 +1,199 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MML batch renderer
+
+Renders MML song files (see genmidi/song.py) to .mid files for Synthesia, in parallel:
+
+    python -m genmidi songs/ "exercises/**/*.mml" [-o out/] [-j 8] [--force] [--watch]
+
+Arguments are song files, directories (their *.mml files) or glob patterns. A .mid file goes next to its song unless
+--output is given. The hash of every rendered song is kept in a manifest in the output directory, songs whose source
+did not change since are skipped. With --watch the songs are rendered again whenever they are saved, only from the
+first edited measure on (see genmidi/incremental.py).
+"""
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, sleep
+
+from genmidi.song import load_song, render
+from genmidi.incremental import IncrementalSong
+
+MANIFEST = ".genmidi.json"
+
+
+def find_songs(patterns):
+    songs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found = glob.glob(os.path.join(pattern, "*.mml"))
+        elif os.path.isfile(pattern):
+            found = [pattern]
+        else:
+            found = glob.glob(pattern, recursive=True)
+            if not found:
+                print(f"No songs match {pattern}")
+        for path in sorted(found):
+            if path not in songs:
+                songs.append(path)
+    return songs
+
+
+def source_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def target_path(source, output):
+    name = os.path.splitext(os.path.basename(source))[0] + ".mid"
+    return os.path.join(output if output else os.path.dirname(source), name)
+
+
+def render_file(source, target):
+    """Render one song, runs in a worker process. Returns (seconds, size), a ValueError or OSError is a bad song."""
+    start = perf_counter()
+    buffer = io.BytesIO()
+    render(load_song(source)).writeFile(buffer)
+    with open(target, "wb") as f:
+        f.write(buffer.getvalue())
+    return perf_counter() - start, buffer.tell()
+
+
+def render_all(files, jobs):
+    """
+    Yield (result, error) of render_file for every (source, target) in order, in a process pool if jobs > 1. Any
+    exception is yielded as the error of its song, so one failing song (or a crashed worker) does not stop the batch.
+    """
+    jobs = max(1, min(jobs or 1, len(files)))
+    if jobs == 1:
+        for source, target in files:
+            try:
+                yield render_file(source, target), None
+            except Exception as e:
+                yield None, e
+        return
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(render_file, source, target) for source, target in files]
+        for future in futures:
+            try:
+                yield future.result(), None
+            except Exception as e:
+                yield None, e
+
+
+def describe(error):
+    """The message of a bad song, with the type of any other exception."""
+    return str(error) if isinstance(error, (ValueError, OSError)) else f"{type(error).__name__}: {error}"
+
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(directory, manifest):
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def watch(songs, output, interval=0.2):
+    """Render the songs incrementally whenever they change, until interrupted."""
+    renderers = {source: IncrementalSong() for source in songs}
+    mtimes = {}
+    while True:
+        for source, renderer in renderers.items():
+            try:
+                mtime = os.stat(source).st_mtime_ns
+            except OSError:
+                continue
+            if mtimes.get(source) == mtime:
+                continue
+            mtimes[source] = mtime
+            target = target_path(source, output)
+            start = perf_counter()
+            try:
+                data = renderer.update(load_song(source))
+                with open(target, "wb") as f:
+                    f.write(data)
+            except Exception as e:
+                print(f"{source}: {describe(e)}")
+                continue
+            print(f"{source} -> {target} {(perf_counter() - start) * 1000:8.1f} ms "
+                  f"{sum(renderer.reencoded):>6} measures rendered")
+        sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m genmidi", description="Render MML song files to MIDI files")
+    parser.add_argument("songs", nargs="+", help="song files, directories or glob patterns")
+    parser.add_argument("-o", "--output", help="directory for the .mid files, default next to the songs")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--force", action="store_true", help="also render the songs that did not change")
+    parser.add_argument("--watch", action="store_true", help="render the edited measures whenever a song is saved")
+    args = parser.parse_args(argv)
+
+    start = perf_counter()
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    if args.watch:
+        try:
+            watch(find_songs(args.songs), args.output)
+        except KeyboardInterrupt:
+            return True
+    manifests = {}  # output directory -> {song path: source hash}
+    todo, unchanged = [], 0
+    for source in find_songs(args.songs):
+        target = target_path(source, args.output)
+        directory = os.path.dirname(target) or "."
+        manifest = manifests.setdefault(directory, load_manifest(directory))
+        key = os.path.relpath(source, directory)
+        digest = source_hash(source)
+        if not args.force and manifest.get(key) == digest and os.path.exists(target):
+            unchanged += 1
+            continue
+        todo.append((source, target, directory, key, digest))
+
+    failed = 0
+    if todo:
+        results = render_all([(source, target) for source, target, *_ in todo], args.jobs)
+        for (source, target, directory, key, digest), (result, error) in zip(todo, results):
+            if error is not None:
+                print(f"{source}: {describe(error)}")
+                manifests[directory].pop(key, None)
+                failed += 1
+                continue
+            seconds, size = result
+            print(f"{source} -> {target} {seconds * 1000:8.1f} ms {size:>8} bytes")
+            manifests[directory][key] = digest
+        for directory, manifest in manifests.items():
+            save_manifest(directory, manifest)
+
+    print(f"{len(todo) - failed} rendered, {unchanged} unchanged, {failed} failed in {perf_counter() - start:.2f} s")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
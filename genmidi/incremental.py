@@ -0,0 +1,262 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' incremental MML rendering
+
+Keeps a rendered song and, when the song is edited, only redoes the measures around the edit:
+
+    renderer = IncrementalSong()
+    data = renderer.update(load_song("song.mml"))  # bytes of the .mid file
+    data = renderer.update(load_song("song.mml"))  # after an edit
+
+Every track keeps its measures with a content hash, the parsed measure and the state of the track's byte encoder
+before the measure, relative to the first tick of the measure (see smf.Track.state). An update compares the measures
+from the front and from the back. Only the measures in between are parsed again, plus any kept measure that follows
+them in a different octave or chord context. A blank that extends notes of earlier measures (see mml.Measure.carry)
+moves the start of the re-encoding back to the measure of the earliest extended note.
+
+Encoding starts at the first affected measure. At the start of each kept measure the encoder state is compared with
+the old state there. Once they match, the old bytes from that measure on are spliced in, and at most the delta time
+of the first event after the edit is written again. When the edit moves the later measures by whole beats, the bytes
+are only reused when the notes of those measures fall on ticks that move with them. That is the case when their
+offsets within the measure are binary fractions of a beat (halves, quarters, ...) but not for triplets, which are
+then encoded again. Tracks without changes keep their bytes, a change to the header or to the tracks of the song
+renders it from scratch.
+"""
+from array import array
+from bisect import bisect_right
+from typing import List
+
+from genmidi import smf
+from genmidi.mml import Measure, MMLError, REST, measures, get_measure
+from genmidi.song import Song, create_file, track_error
+
+
+def reach_back(measure: Measure, first_note: int) -> int:
+    """Index of the earliest note a measure extends, first_note is the index of its own first note."""
+    return max(first_note - len(measure.carry), 0)
+
+
+def exact(measure: Measure) -> bool:
+    """Whether the ticks of the notes move with the measure when it moves by whole beats, see the module docs."""
+    return all((start * 1048576).is_integer() for start in measure.starts)
+
+
+class Render:
+    """The sizes and states of the old render of a track and its bytes from the first kept measure on."""
+    def __init__(self, sizes, states, old_suffix, data):
+        self.sizes = sizes
+        self.states = states
+        self.tail_start = sizes[old_suffix] if old_suffix < len(sizes) else len(data)
+        self.tail = bytes(data[self.tail_start:])
+
+
+class IncrementalTrack:
+    def __init__(self, mf: smf.MIDIFile, index: int):
+        self.mf = mf
+        self.index = index
+        self.track = mf.tracks[index + 1]
+        self.hashes = []  # content hash of each measure
+        self.texts = []
+        self.measures: List[Measure] = []
+        self.exact = []  # exact() of each measure
+        self.beats = [0]  # first beat of each measure, and the number of beats
+        self.first_notes = [0]  # index of the first note of each measure, and the number of notes
+        self.durations = array("d")  # of the notes, with the extensions by later measures
+        self.sizes = []  # bytes in the track before each measure and at the end
+        self.states = []  # encoder state before each measure and at the end, relative to its first tick
+        self.max_carry = 0  # the most notes a measure of the track extended
+        self.chunk = None
+
+    def update(self, text: str) -> int:
+        """Render the changed measures of the track, returns the number of measures re-encoded."""
+        spans = list(measures(text))
+        texts = [text[start:end + 1] for start, end in spans]
+        hashes = [hash(measure) for measure in texts]
+        old_texts, old_hashes = self.texts, self.hashes
+        old, new = len(old_texts), len(texts)
+        common = min(old, new)
+        changed = 0
+        while changed < common and hashes[changed] == old_hashes[changed] and texts[changed] == old_texts[changed]:
+            changed += 1
+        if changed == old == new:
+            return 0
+        same = 0  # measures at the end that did not change either
+        while same < common - changed and hashes[new - 1 - same] == old_hashes[old - 1 - same] and \
+                texts[new - 1 - same] == old_texts[old - 1 - same]:
+            same += 1
+
+        # Parse before touching any state, an MMLError leaves the track as it was. A measure at the end is kept
+        # unless it depends on an octave or chord context that changed.
+        previous = self.measures[changed - 1] if changed else None
+        octave, num_conc = (previous.octave, previous.num_conc) if previous else (0, 0)
+        parsed = []
+        for number in range(changed, new):
+            if number >= new - same:
+                kept = self.measures[number - new + old]
+                if (kept.octave_in is None or kept.octave_in == octave) and \
+                        (kept.num_conc_in is None or kept.num_conc_in == num_conc):
+                    break
+            start, end = spans[number]
+            measure = get_measure(text, start, end, number + 1, octave, num_conc)
+            parsed.append(measure)
+            octave, num_conc = measure.octave, measure.num_conc
+        suffix = changed + len(parsed)  # the first measure kept from the old render
+        old_suffix = suffix - new + old
+
+        old_measures, old_first_notes, old_beats = self.measures, self.first_notes, self.beats
+        all_measures = old_measures[:changed] + parsed + old_measures[old_suffix:]
+        first_notes, beats = old_first_notes[:changed + 1], old_beats[:changed + 1]
+        for measure in parsed:
+            first_notes.append(first_notes[-1] + len(measure.pitches))
+            beats.append(beats[-1] + measure.beats)
+        moved_notes = first_notes[suffix] - old_first_notes[old_suffix]
+        moved_beats = beats[suffix] - old_beats[old_suffix]
+        first_notes += [first_note + moved_notes for first_note in old_first_notes[old_suffix + 1:]]
+        beats += [beat + moved_beats for beat in old_beats[old_suffix + 1:]]
+        self.max_carry = max([self.max_carry] + [len(measure.carry) for measure in parsed])
+
+        # Restart at the measure of the earliest note extended by a replaced measure, a new one or a kept one that
+        # now extends other notes than before
+        reach = first_notes[changed]
+        for measure, first_note in zip(old_measures[changed:old_suffix], old_first_notes[changed:old_suffix]):
+            reach = min(reach, reach_back(measure, first_note))
+        for measure, first_note in zip(parsed, first_notes[changed:suffix]):
+            reach = min(reach, reach_back(measure, first_note))
+        for m in range(suffix, new):
+            if first_notes[m] - first_notes[suffix] >= self.max_carry:
+                break
+            reach = min(reach, reach_back(all_measures[m], first_notes[m]),
+                        reach_back(all_measures[m], old_first_notes[m - suffix + old_suffix]))
+        restart = changed
+        while reach < first_notes[restart]:
+            restart = bisect_right(first_notes, reach, 0, restart) - 1
+            for measure, first_note in zip(all_measures[restart:changed], first_notes[restart:changed]):
+                reach = min(reach, reach_back(measure, first_note))
+
+        # The durations from the restart on: the notes of the measures up to the kept ones extended in order, the
+        # kept notes as they were, then the extensions of earlier notes by kept measures
+        durations = self.durations[:first_notes[restart]]
+        for measure in all_measures[restart:suffix]:
+            for i in range(min(len(measure.carry), len(durations))):
+                durations[-i - 1] += measure.carry[i]
+            durations.extend(measure.durations)
+        durations.extend(self.durations[old_first_notes[old_suffix]:])
+        for m in range(suffix, new):
+            if first_notes[m] - first_notes[suffix] >= self.max_carry:
+                break
+            carry = all_measures[m].carry
+            for i in range(len(carry)):
+                note = first_notes[m] - 1 - i
+                if 0 <= note < first_notes[suffix]:
+                    durations[note] += carry[i]
+
+        old_exact = self.exact
+        self.exact = old_exact[:changed] + [exact(measure) for measure in parsed] + old_exact[old_suffix:]
+        self.hashes, self.texts, self.measures = hashes, texts, all_measures
+        self.first_notes, self.beats, self.durations = first_notes, beats, durations
+        encoded = self.encode(restart, suffix, old_suffix, moved_beats)
+        self.chunk = None
+        return encoded
+
+    def encode(self, restart, suffix, old_suffix, moved_beats):
+        """
+        Encode the measures from restart on, with a state before every measure. From measure suffix on the measures
+        are those of the old render from old_suffix on, moved by moved_beats: their old bytes are spliced in as soon
+        as the state allows it. Returns the number of measures encoded.
+        """
+        track, mf = self.track, self.mf
+        old = Render(self.sizes, self.states, old_suffix, track.data)
+        if restart < len(old.states):
+            track.resume(old.sizes[restart], mf.ticks(self.beats[restart]), old.states[restart])
+        self.sizes, self.states = sizes, states = old.sizes[:restart], old.states[:restart]
+        beats, first_notes, durations = self.beats, self.first_notes, self.durations
+        count = len(self.measures)
+        for m in range(restart, count + 1):
+            tick = mf.ticks(beats[m])
+            if m:
+                track.advance(tick - 1)  # the notes that end before the measure
+            state = track.state(tick)
+            if suffix <= m < count and self.splice(m, old, m - suffix + old_suffix, state, moved_beats):
+                return m - restart
+            sizes.append(len(track.data))
+            states.append(state)
+            if m < count:
+                measure = self.measures[m]
+                beat, first = beats[m], first_notes[m]
+                for j, pitch in enumerate(measure.pitches):
+                    if pitch != REST:
+                        mf.addNote(track=self.index, channel=0, pitch=pitch, time=beat + measure.starts[j],
+                                   duration=durations[first + j], volume=100)
+        return count - restart
+
+    def splice(self, m, old, old_m, state, moved_beats) -> bool:
+        """Append the old bytes from old measure old_m on as measure m, when the state allows it."""
+        old_state = old.states[old_m]
+        if state[1:] != old_state[1:] or (moved_beats and not all(self.exact[m:])):
+            return False
+        track = self.track
+        size = len(track.data)
+        pos = old.sizes[old_m] - old.tail_start
+        if state[0] == old_state[0]:
+            track.data += old.tail[pos:]
+            shift = size - old.sizes[old_m]
+        else:
+            # The last event before the measure differs, the first event after it gets another delta time. That
+            # needs an event in the old measure, after which the later sizes all move the same.
+            if old.sizes[old_m + 1] == old.sizes[old_m]:
+                return False
+            delta, end = smf.read_vlq(old.tail, pos)
+            track.data += smf.vlq(delta + old_state[0] - state[0])
+            shift = len(track.data) - old.tail_start - end
+            track.data += old.tail[end:]
+        self.sizes.append(size)
+        self.states.append(state)
+        self.sizes += [old_size + shift for old_size in old.sizes[old_m + 1:]]
+        self.states += old.states[old_m + 1:]
+        track.resume(len(track.data), self.mf.ticks(self.beats[-1]), self.states[-1])
+        return True
+
+    def get_chunk(self) -> bytes:
+        if self.chunk is None:
+            self.chunk = self.track.chunk()
+        return self.chunk
+
+
+class IncrementalSong:
+    """Renders a song and its edits, see the module documentation."""
+    def __init__(self):
+        self.header = None
+        self.mf = None
+        self.tracks: List[IncrementalTrack] = []
+        self.reencoded = []  # measures re-encoded per track by the last update
+
+    def update(self, song: Song) -> bytes:
+        """The song as .mid file bytes, raises a ValueError with the line number on errors in the markup."""
+        header = song._replace(tracks=tuple(track.name for track in song.tracks))
+        if header != self.header:
+            self.mf = create_file(song)
+            self.tracks = [IncrementalTrack(self.mf, i) for i in range(len(song.tracks))]
+            self.header = header
+        reencoded = []
+        for track, incremental in zip(song.tracks, self.tracks):
+            try:
+                reencoded.append(incremental.update(track.notes))
+            except MMLError as e:
+                raise track_error(track, e) from None
+        self.reencoded = reencoded
+        return self.mf.header() + self.mf.tracks[0].chunk() + b"".join(track.get_chunk() for track in self.tracks)
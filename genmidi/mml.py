@@ -0,0 +1,292 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI Markup Language (DrC's MML) parser
+
+    [E5 |E, F, G |E ,C |  ][  |D, C |Eb, Db |C, Bb4 ]
+
+A measure is enclosed in [], | separates the beats of a measure, the notes of a beat separated by , share the beat
+equally and notes joined by + sound together. A note is a name (C, C#, Db, ..., B, or X for a rest) with an optional
+octave digit, without it the octave of the previous note is used. Cb4 is B3 and B#4 is C5. A blank beat, or a blank
+between , or +, extends the previous notes. Spaces and dots are ignored.
+
+parse() reads the text in one pass with a single regular expression and returns the notes as arrays of pitch, start
+and duration in beats. Measures are parsed on their own, relative to their first beat, and kept in an LRU cache
+keyed on the measure text, so a repeated measure or chord pattern is only parsed once.
+"""
+import re
+from array import array
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+NOTES = {"X": 0,  # rest
+         "Cb": 59,  # B of the octave below
+         "C": 60,
+         "C#": 61, "Db": 61,
+         "D": 62,
+         "D#": 63, "Eb": 63,
+         "E": 64, "Fb": 64,
+         "F": 65, "E#": 65,
+         "F#": 66, "Gb": 66,
+         "G": 67,
+         "G#": 68, "Ab": 68,
+         "A": 69,
+         "A#": 70, "Bb": 70,
+         "B": 71,
+         "B#": 72}  # C of the octave above
+
+REST = 0
+
+TOKENS = re.compile(r"(?P<note>(?P<name>[A-GX][#b]?)(?P<octave>\d?))|(?P<sep>[\[\]|,+])|(?P<blank>[\s.]+)|(?P<other>.)")
+BLANK = re.compile(r"[\s.]*")
+
+
+class MMLError(ValueError):
+    """
+    Syntax error at text[offset]: measure is the 1-based measure number, line and column the 1-based position in the
+    line of the text the error is on.
+    """
+    def __init__(self, message, measure, text, offset):
+        line_start = text.rfind("\n", 0, offset) + 1
+        self.message = message
+        self.measure = measure
+        self.offset = offset
+        self.line = text.count("\n", 0, line_start) + 1
+        self.column = offset - line_start + 1
+        super().__init__(f"measure {measure}, line {self.line}, column {self.column}: {message}")
+
+
+class Notes:
+    """Parsed notes, rests included (pitch REST) as they can be extended like notes."""
+    __slots__ = ("pitches", "starts", "durations")
+
+    def __init__(self):
+        self.pitches = array("h")
+        self.starts = array("d")
+        self.durations = array("d")
+
+    def __len__(self):
+        return len(self.pitches)
+
+    def append(self, pitch, start, duration):
+        self.pitches.append(pitch)
+        self.starts.append(start)
+        self.durations.append(duration)
+
+    def append_measure(self, measure, beat):
+        """Append the notes of a Measure starting at beat, after extending the notes before it by its carry."""
+        durations = self.durations
+        for i in range(min(len(measure.carry), len(durations))):
+            durations[-i - 1] += measure.carry[i]
+        self.pitches.extend(measure.pitches)
+        self.starts.extend([beat + start for start in measure.starts])
+        durations.extend(measure.durations)
+
+    def extend_last(self, count, duration):
+        """Extend the last count notes, e.g. the notes of the previous chord."""
+        durations = self.durations
+        for i in range(1, min(count, len(durations)) + 1):
+            durations[-i] += duration
+
+    def __iter__(self):
+        """(pitch, start, duration) of the notes, without the rests."""
+        return ((p, s, d) for p, s, d in zip(self.pitches, self.starts, self.durations) if p != REST)
+
+
+class Measure(NamedTuple):
+    """A parsed measure, the notes start relative to its first beat."""
+    pitches: array
+    starts: array
+    durations: array
+    carry: Tuple[float, ...]  # added to the durations of the notes before the measure, the last one first
+    beats: int
+    octave: int  # octave and number of concurrent notes after the measure
+    num_conc: int
+    octave_in: Optional[int]  # the context the measure was parsed in, None when the result does not depend on it
+    num_conc_in: Optional[int]
+
+
+class ParseCache:
+    """LRU cache of parsed measures keyed on their text, one entry per text."""
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.measures = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, octave, num_conc) -> Optional[Measure]:
+        measure = self.measures.get(key)
+        if measure is None or (measure.octave_in is not None and measure.octave_in != octave) or \
+                (measure.num_conc_in is not None and measure.num_conc_in != num_conc):
+            self.misses += 1
+            return None
+        self.measures.move_to_end(key)
+        self.hits += 1
+        return measure
+
+    def put(self, key, measure: Measure):
+        self.measures[key] = measure
+        self.measures.move_to_end(key)
+        if len(self.measures) > self.maxsize:
+            self.measures.popitem(last=False)
+
+    def clear(self):
+        self.measures.clear()
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return f"ParseCache(hits={self.hits}, misses={self.misses}, size={len(self.measures)}/{self.maxsize})"
+
+
+cache = ParseCache()
+
+
+def parse_measure(text: str, start: int, end: int, number: int, octave: int, num_conc: int) -> Measure:
+    """Parse text[start:end], the measure without its brackets, number is the measure number for errors."""
+    notes = Notes()
+    carry = []
+    octave_in = num_conc_in = None
+    octave_set = num_conc_set = False
+    beat = 0
+    groups = [[None]]  # the , separated groups of the current beat, each a list of + separated pitches, None if blank
+    has_content = False
+
+    def extend(count, duration):
+        nonlocal num_conc_in
+        if not num_conc_set:
+            num_conc_in = count
+        notes.extend_last(count, duration)
+        for i in range(count - len(notes)):  # the remainder extends the notes of the measures before
+            if i < len(carry):
+                carry[i] += duration
+            else:
+                carry.append(duration)
+
+    def end_beat():
+        nonlocal beat, num_conc, num_conc_set
+        if not has_content:  # a blank beat connects the previous notes
+            extend(num_conc, 1)
+        else:
+            duration = round(1 / len(groups), 2)
+            sub_beat = beat
+            for group in groups:
+                for pitch in group:
+                    if pitch is None:
+                        extend(num_conc, duration)
+                    else:
+                        notes.append(pitch, sub_beat, duration)
+                num_conc = len(group)
+                num_conc_set = True
+                sub_beat += duration
+        beat += 1
+
+    for match in TOKENS.finditer(text, start, end):
+        kind = match.lastgroup
+        if kind == "blank":
+            continue
+        value = match.group()
+        if kind == "other":
+            raise MMLError(f"unexpected {value!r}", number, text, match.start())
+        if kind == "note":
+            group = groups[-1]
+            if group[-1] is not None:
+                raise MMLError(f"missing , or + before {value!r}", number, text, match.start())
+            name = match.group("name")
+            if name == "X":
+                pitch = REST
+            elif name not in NOTES:
+                raise MMLError(f"unknown note {name!r}", number, text, match.start())
+            else:
+                if match.group("octave"):
+                    octave = int(match.group("octave"))
+                    octave_set = True
+                elif not octave_set:
+                    octave_in = octave
+                pitch = NOTES[name] + (octave - 4) * 12
+                if pitch > 127:
+                    raise MMLError(f"note {value} out of range", number, text, match.start())
+            group[-1] = pitch
+            has_content = True
+        elif value == "+":
+            groups[-1].append(None)
+            has_content = True
+        elif value == ",":
+            groups.append([None])
+            has_content = True
+        elif value == "|":
+            end_beat()
+            groups = [[None]]
+            has_content = False
+        else:  # [ or ]
+            raise MMLError("missing ]" if value == "[" else "unexpected ]", number, text, match.start())
+    end_beat()
+    # Without an octave digit or a group of notes the octave or count is passed on, which depends on the input too
+    if not octave_set:
+        octave_in = octave
+    if not num_conc_set:
+        num_conc_in = num_conc
+    return Measure(notes.pitches, notes.starts, notes.durations, tuple(carry), beat, octave, num_conc,
+                   octave_in, num_conc_in)
+
+
+def measures(text: str):
+    """Yield (start, end) of every measure, the offsets of its [ and ]. Raises an MMLError on text outside measures."""
+    pos = 0
+    number = 0
+    while True:
+        start = text.find("[", pos)
+        stop = len(text) if start < 0 else start
+        blank_end = BLANK.match(text, pos, stop).end()
+        if blank_end != stop:
+            raise MMLError(f"expected [ instead of {text[blank_end]!r}", number + 1, text, blank_end)
+        if start < 0:
+            return
+        number += 1
+        end = text.find("]", start + 1)
+        if end < 0:
+            raise MMLError("missing ]", number, text, len(text))
+        yield start, end
+        pos = end + 1
+
+
+def get_measure(text: str, start: int, end: int, number: int, octave: int, num_conc: int,
+                cache: Optional[ParseCache] = cache) -> Measure:
+    """The measure text[start:end + 1] parsed in the given context, from the cache when it is there."""
+    key = text[start:end + 1]
+    measure = cache.get(key, octave, num_conc) if cache is not None else None
+    if measure is None:
+        measure = parse_measure(text, start + 1, end, number, octave, num_conc)
+        if cache is not None:
+            cache.put(key, measure)
+    return measure
+
+
+def parse(text: str, octave=0, cache: Optional[ParseCache] = cache) -> Notes:
+    """
+    Parse the markup, octave is the octave of notes without one until the first octave digit. Pass cache=None to
+    parse without the measure cache.
+    """
+    notes = Notes()
+    beat = 0
+    num_conc = 0  # notes in the previous group of concurrent notes, a blank extends them
+    for number, (start, end) in enumerate(measures(text), 1):
+        measure = get_measure(text, start, end, number, octave, num_conc, cache)
+        notes.append_measure(measure, beat)
+        beat += measure.beats
+        octave = measure.octave
+        num_conc = measure.num_conc
+    return notes
@@ -0,0 +1,225 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' Standard MIDI File writer
+
+Writes type 1 files with the calls genmidi uses from midiutil.MIDIFile (addNote, addTempo, addTrackName,
+addTimeSignature, addKeySignature and writeFile). Like midiutil, tempo, time and key signatures go to a tempo track
+in front of the numTracks note tracks, times are in beats and there are 960 ticks per beat.
+
+Events are encoded into a bytearray per track as they are added, nothing is kept as objects and nothing is sorted at
+the end. The price is that the events of a track must be added in time order. Note offs wait in a small heap per track
+until the track passes their time. A note that starts while the same pitch is still sounding ends the earlier one.
+"""
+import heapq
+import struct
+from typing import BinaryIO, Union
+
+SHARPS = 1
+FLATS = -1
+MAJOR = 0
+MINOR = 1
+
+TICKS_PER_QUARTER = 960
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+META = 0xFF
+META_TRACK_NAME = 0x03
+META_END_OF_TRACK = 0x2F
+META_TEMPO = 0x51
+META_TIME_SIGNATURE = 0x58
+META_KEY_SIGNATURE = 0x59
+
+
+def vlq(value: int) -> bytes:
+    """value as a variable-length quantity, seven bits per byte with the most significant first."""
+    result = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        result.append(0x80 | (value & 0x7F))
+        value >>= 7
+    result.reverse()
+    return bytes(result)
+
+
+def read_vlq(data, pos):
+    """The variable-length quantity at data[pos] and the offset after it."""
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+VLQ = [vlq(i) for i in range(1 << 14)]  # every delta time up to 16383 ticks (4 bars of 4/4) is one lookup
+
+
+class Track:
+    def __init__(self):
+        self.data = bytearray()
+        self.tick = 0  # time of the last event written
+        self.note_offs = []  # heap of [tick, order, status, pitch, velocity, note on tick], status 0 when cancelled
+        self.sounding = {}  # (status, pitch) of a note on -> its entry in note_offs
+        self.order = 0
+        self.meta = set()  # meta events written at the current tick, to drop duplicates like midiutil does
+        self.closed = False
+
+    def put(self, tick, event: bytes):
+        delta = tick - self.tick
+        self.data += VLQ[delta] if delta < 16384 else vlq(delta)
+        self.data += event
+        if delta:
+            self.meta.clear()
+            self.tick = tick
+
+    def advance(self, tick):
+        """Write the note offs up to and including tick."""
+        if tick < self.tick:
+            raise ValueError(f"Event at tick {tick} added after tick {self.tick}, add the events of a track in order")
+        note_offs = self.note_offs
+        while note_offs and note_offs[0][0] <= tick:
+            off_tick, _, status, pitch, velocity, _ = heapq.heappop(note_offs)
+            if status:
+                self.put(off_tick, bytes((status, pitch, velocity)))
+                del self.sounding[status | NOTE_ON, pitch]
+
+    def note(self, tick, duration, channel, pitch, velocity):
+        self.advance(tick)
+        status = NOTE_ON | channel
+        sounding = self.sounding.get((status, pitch))
+        if sounding is not None:
+            if sounding[5] == tick:  # the same note twice
+                return
+            self.put(tick, bytes((sounding[2], pitch, sounding[4])))
+            sounding[2] = 0
+        self.put(tick, bytes((status, pitch, velocity)))
+        entry = [tick + duration, self.order, NOTE_OFF | channel, pitch, velocity, tick]
+        self.order += 1
+        self.sounding[status, pitch] = entry
+        heapq.heappush(self.note_offs, entry)
+
+    def meta_event(self, tick, kind, payload: bytes):
+        self.advance(tick)
+        event = bytes((META, kind)) + vlq(len(payload)) + payload
+        if tick == self.tick and event in self.meta:
+            return
+        self.put(tick, event)
+        self.meta.add(event)
+
+    def close(self):
+        if not self.closed:
+            self.advance(max((entry[0] for entry in self.note_offs), default=self.tick))
+            self.put(self.tick, bytes((META, META_END_OF_TRACK, 0)))
+            self.closed = True
+
+    def checkpoint(self):
+        """The state of the track, restore() rewinds the track to it."""
+        return len(self.data), self.tick, self.order, [list(entry) for entry in self.note_offs if entry[2]], \
+            set(self.meta)
+
+    def restore(self, checkpoint):
+        size, self.tick, self.order, note_offs, meta = checkpoint
+        del self.data[size:]
+        self.note_offs = [list(entry) for entry in note_offs]
+        heapq.heapify(self.note_offs)
+        self.sounding = {(entry[2] | NOTE_ON, entry[3]): entry for entry in self.note_offs}
+        self.meta = set(meta)
+        self.closed = False
+
+    def state(self, tick):
+        """
+        The state of the track relative to tick: tracks in the same state write the same bytes when the events that
+        follow are the same relative to tick. resume() puts a track back in a state.
+        """
+        pending = sorted(entry for entry in self.note_offs if entry[2])
+        return self.tick - tick, tuple((off - tick, status, pitch, velocity, on - tick)
+                                       for off, _, status, pitch, velocity, on in pending), frozenset(self.meta)
+
+    def resume(self, size, tick, state):
+        """Rewind the track to its first size bytes, in a state taken relative to tick."""
+        last, pending, meta = state
+        del self.data[size:]
+        self.tick = tick + last
+        # Sorted on tick and order, the list is a heap
+        self.note_offs = [[off + tick, order, status, pitch, velocity, on + tick]
+                          for order, (off, status, pitch, velocity, on) in enumerate(pending)]
+        self.order = len(pending)
+        self.sounding = {(entry[2] | NOTE_ON, entry[3]): entry for entry in self.note_offs}
+        self.meta = set(meta)
+        self.closed = False
+
+    def chunk(self) -> bytes:
+        """The MTrk chunk of the track as if it ended now, the track stays open."""
+        if self.closed:
+            return b"MTrk" + struct.pack(">L", len(self.data)) + self.data
+        checkpoint = self.checkpoint()
+        self.close()
+        chunk = b"MTrk" + struct.pack(">L", len(self.data)) + self.data
+        self.restore(checkpoint)
+        return chunk
+
+
+class MIDIFile:
+    """A type 1 Standard MIDI File with a tempo track and numTracks note tracks."""
+    def __init__(self, numTracks=1, ticks_per_quarternote=TICKS_PER_QUARTER):
+        self.num_tracks = numTracks
+        self.ticks_per_quarter = ticks_per_quarternote
+        self.tracks = [Track() for _ in range(numTracks + 1)]
+
+    def ticks(self, time):
+        return int(time * self.ticks_per_quarter)
+
+    def addNote(self, track, channel, pitch, time, duration, volume):
+        self.tracks[track + 1].note(self.ticks(time), self.ticks(duration), channel, pitch, volume)
+
+    def addTrackName(self, track, time, trackName):
+        self.tracks[track + 1].meta_event(self.ticks(time), META_TRACK_NAME, trackName.encode("ISO-8859-1"))
+
+    def addTempo(self, track, time, tempo):
+        """The tempo in beats per minute, track is ignored as the tempo track holds the tempo."""
+        self.tracks[0].meta_event(self.ticks(time), META_TEMPO, struct.pack(">L", int(60000000 / tempo))[1:])
+
+    def addTimeSignature(self, track, time, numerator, denominator, clocks_per_tick, notes_per_quarter=8):
+        """denominator is a power of two (2 for a quarter), track is ignored."""
+        self.tracks[0].meta_event(self.ticks(time), META_TIME_SIGNATURE,
+                                  bytes((numerator, denominator, clocks_per_tick, notes_per_quarter)))
+
+    def addKeySignature(self, track, time, accidentals, accidental_type, mode):
+        """accidental_type is SHARPS or FLATS and mode MAJOR or MINOR, track is ignored."""
+        self.tracks[0].meta_event(self.ticks(time), META_KEY_SIGNATURE,
+                                  struct.pack(">bB", accidentals * accidental_type, mode))
+
+    def header(self) -> bytes:
+        return b"MThd" + struct.pack(">LHHH", 6, 1, len(self.tracks), self.ticks_per_quarter)
+
+    def getvalue(self) -> bytes:
+        """The file as bytes, the tracks stay open for more events."""
+        return self.header() + b"".join(track.chunk() for track in self.tracks)
+
+    def writeFile(self, fileHandle: Union[BinaryIO, str]):
+        """Write to a binary file object (e.g. a BytesIO) or a path. Ends the tracks, no events can be added after."""
+        if isinstance(fileHandle, str):
+            with open(fileHandle, "wb") as f:
+                return self.writeFile(f)
+        fileHandle.write(self.header())
+        for track in self.tracks:
+            track.close()
+            fileHandle.write(b"MTrk" + struct.pack(">L", len(track.data)))
+            fileHandle.write(track.data)
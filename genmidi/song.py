@@ -0,0 +1,151 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MML song files
+
+A song file holds a header, definitions and a track section per hand (see genmidi/songs/JustForYou.mml):
+
+    # Lines starting with # are comments
+    tempo: 60
+    time: 4/4
+    key: 1 flat major
+
+    Fmaj7 = F3+A3+C4+E4
+
+    track right_hand
+    [E5 |E, F, G |E ,C | ]
+
+    track left_hand
+    [{Fmaj7} |{Fmaj7} |{Dm7} |{Dm7} ]
+
+The key is "C major", "A minor" or a number of sharps or flats and major or minor. {Name} in a track is replaced by
+the definition of Name.
+"""
+import re
+from typing import NamedTuple, Tuple
+
+from genmidi import smf
+from genmidi.main import create, add_notes
+from genmidi.mml import MMLError
+
+HEADER = re.compile(r"(?P<key>tempo|time|key)\s*:\s*(?P<value>.*)$")
+DEFINITION = re.compile(r"(?P<name>\w+)\s*=\s*(?P<value>.*)$")
+TRACK = re.compile(r"track\s+(?P<name>\w+)$")
+KEY = re.compile(r"(?:(?P<count>\d+)\s+(?P<sign>flats?|sharps?)|[CA])\s+(?P<scale>major|minor)$")
+REFERENCE = re.compile(r"\{(\w+)\}")
+
+
+class Track(NamedTuple):
+    name: str
+    notes: str  # the markup with the definitions filled in, lines joined by newlines
+    lines: Tuple[int, ...]  # the line number of each line of notes
+
+
+class Song(NamedTuple):
+    tempo: int = 120
+    numerator: int = 4
+    denominator: int = 4
+    accidentals: int = 0
+    sign: int = smf.SHARPS
+    scale: int = smf.MAJOR
+    tracks: Tuple[Track, ...] = ()
+
+
+def parse_key(value):
+    match = KEY.match(value)
+    if match is None:
+        raise ValueError(f"Key {value} is not like C major, A minor, 1 flat major or 2 sharps minor")
+    scale = smf.MAJOR if match.group("scale") == "major" else smf.MINOR
+    if match.group("count") is None:
+        return 0, smf.SHARPS, scale
+    return int(match.group("count")), smf.FLATS if match.group("sign").startswith("flat") else smf.SHARPS, scale
+
+
+def parse_song(text: str) -> Song:
+    """Parse a song file, raises a ValueError naming the line on errors in the header or definitions."""
+    header, definitions, tracks = {}, {}, []
+    track = None  # (name, lines, line numbers) of the current track
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            match = TRACK.match(line)
+            if match:
+                track = (match.group("name"), [], [])
+                tracks.append(track)
+            elif track is not None:
+                track[1].append(REFERENCE.sub(lambda m: definitions[m.group(1)], line))
+                track[2].append(number)
+            elif HEADER.match(line):
+                match = HEADER.match(line)
+                header[match.group("key")] = match.group("value").strip()
+            elif DEFINITION.match(line):
+                match = DEFINITION.match(line)
+                definitions[match.group("name")] = match.group("value").strip()
+            else:
+                raise ValueError(f"Expected tempo:, time:, key:, a definition or a track, not {line}")
+        except KeyError as e:
+            raise ValueError(f"line {number}: {e.args[0]} is not defined") from None
+        except ValueError as e:
+            raise ValueError(f"line {number}: {e}") from None
+    if not tracks:
+        raise ValueError("No tracks")
+
+    song = Song(tracks=tuple(Track(name, "\n".join(lines), tuple(numbers)) for name, lines, numbers in tracks))
+    try:
+        if "tempo" in header:
+            song = song._replace(tempo=int(header["tempo"]))
+        if "time" in header:
+            numerator, denominator = (int(value) for value in header["time"].split("/"))
+            if denominator not in (2, 4, 8, 16):
+                raise ValueError(f"Time {header['time']} is not over 2, 4, 8 or 16")
+            song = song._replace(numerator=numerator, denominator=denominator)
+        if "key" in header:
+            accidentals, sign, scale = parse_key(header["key"])
+            song = song._replace(accidentals=accidentals, sign=sign, scale=scale)
+    except ValueError as e:
+        raise ValueError(f"header: {e}") from None
+    return song
+
+
+def load_song(path) -> Song:
+    with open(path) as f:
+        return parse_song(f.read())
+
+
+def create_file(song: Song) -> smf.MIDIFile:
+    """A MIDI file with the tempo, time and key signature and the tracks of the song, without notes."""
+    return create(num=song.numerator, den=song.denominator, sign=song.sign, scale=song.scale, tempo=song.tempo,
+                  accidentals=song.accidentals, track_names=[track.name for track in song.tracks])
+
+
+def track_error(track: Track, error: MMLError) -> ValueError:
+    line = track.lines[error.line - 1]
+    return ValueError(f"line {line}, column {error.column}: track {track.name}, measure {error.measure}: "
+                      f"{error.message}")
+
+
+def render(song: Song) -> smf.MIDIFile:
+    """The song as a MIDI file, an MMLError in a track is raised as a ValueError with the line number."""
+    mf = create_file(song)
+    for i, track in enumerate(song.tracks):
+        try:
+            add_notes(mf, i, track.notes)
+        except MMLError as e:
+            raise track_error(track, e) from None
+    return mf
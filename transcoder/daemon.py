@@ -0,0 +1,331 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI Transcoder daemon
+
+Runs the routes of a TOML or JSON config file without any user interaction and reloads the file when it changes:
+
+    python -m transcoder.daemon routes.toml [--quiet|--verbose] [--stats[=dump.json]]
+
+A config names the devices, optionally defines note maps and lists the routes, each a pipeline from one input to
+one output (see transcoder/routes.toml):
+
+    [devices]
+    drums = "Band Hero"
+    volca = "UM-ONE"
+
+    [[routes]]
+    input = "drums"
+    output = "volca"
+    stages = [{stage = "filter", channels = [9]}, {stage = "remap", map = "BH_TO_VB"}]
+
+On a reload the new pipelines are compiled on the watcher thread and swapped in with a single assignment, the event
+loop picks them up at its next read. Stateful stages (round_robin) whose route and settings did not change are
+carried over, so sounding notes keep their voices. Notes held by a removed stateful stage are released and
+devices no route uses anymore are closed.
+"""
+import heapq
+import json
+import os
+import sys
+import threading
+from time import perf_counter_ns
+from typing import NamedTuple, Tuple, Dict, Any
+
+from transcoder.utils.midi import full_note_to_number, write_batch, AdaptiveSleep, InputMux, MAX_LATENCY_US, NOTE_OFF
+from transcoder.utils.pipeline import Pipeline, Filter, Thru, Remap, Transpose, Channel, VelocityCurve, VelocityCC, \
+    RoundRobin
+from transcoder.utils.log import message_log, VERBOSITY_OFF, VERBOSITY_ALL
+from transcoder.utils.stats import get_stats, report_periodically
+from transcoder.utils.devices import devices
+from transcoder.utils.backends import get_backend
+from transcoder import transcode
+
+BUILTIN_MAPS = {"BH_TO_VB": transcode.BH_TO_VB, "BH_TO_MC": transcode.BH_TO_MC}
+
+
+def load_config(path):
+    """Read a .toml (Python 3.11+) or .json config file."""
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def channel_mask(channels):
+    """A list of channels (0-15) as a bit mask, an int is taken as a mask already."""
+    if isinstance(channels, int):
+        return channels
+    mask = 0
+    for channel in channels:
+        if not 0 <= channel < 16:
+            raise ValueError(f"Channel {channel} out of range")
+        mask |= 1 << channel
+    return mask
+
+
+def note_number(note):
+    return full_note_to_number(note) if isinstance(note, str) else note
+
+
+def get_map(config, name):
+    """A map is a named [maps] entry or a builtin map, rules are [channel_from, note_from, channel_to, note_to]."""
+    maps = config.get("maps", {})
+    if isinstance(name, list):
+        rules = name
+    elif name in maps:
+        rules = maps[name]
+    elif name in BUILTIN_MAPS:
+        rules = BUILTIN_MAPS[name]
+    else:
+        raise ValueError(f"Unknown map {name}")
+    return [[ch_from, note_number(note_from), ch_to, note_number(note_to)]
+            for ch_from, note_from, ch_to, note_to in rules]
+
+
+def make_stage(config, spec):
+    kind = spec.get("stage")
+    args = {key: value for key, value in spec.items() if key != "stage"}
+    if "channels" in args and kind != "round_robin":
+        args["channels"] = channel_mask(args["channels"])
+    for key in ("low", "high"):
+        if key in args:
+            args[key] = note_number(args[key])
+    if kind == "filter":
+        return Filter(**args)
+    if kind == "thru":
+        return Thru(**args)
+    if kind == "remap":
+        return Remap(get_map(config, args.pop("map")), **args)
+    if kind == "transpose":
+        return Transpose(**args)
+    if kind == "channel":
+        return Channel(**args)
+    if kind == "velocity_curve":
+        return VelocityCurve(**args)
+    if kind == "velocity_cc":
+        return VelocityCC(**args)
+    if kind == "round_robin":
+        return RoundRobin(**args)
+    raise ValueError(f"Unknown stage {kind}")
+
+
+class Routes(NamedTuple):
+    """Immutable routing snapshot, replaced as a whole on reload."""
+    inputs: Tuple[str, ...]  # device keys, in InputMux port order
+    outputs: Tuple[str, ...]
+    routes: Tuple[Tuple[Tuple[Pipeline, int], ...], ...]  # per input port: (pipeline, output index)
+    stateful: Dict[Any, Any]  # (input, output, stage spec, occurrence) -> stage, reused by the next build
+    release: Tuple[Tuple[Any, Any], ...]  # (output port, removed stateful stage) to silence when swapped in
+    input_ports: Tuple[Any, ...] = ()  # the opened devices, in the order of inputs and outputs
+    output_ports: Tuple[Any, ...] = ()
+
+
+def build_routes(config, previous: Routes = None) -> Routes:
+    devices = config.get("devices", {})
+    inputs, outputs, stateful, per_input = [], [], {}, {}
+    for route in config.get("routes", []):
+        for key in (route["input"], route["output"]):
+            if key not in devices:
+                raise ValueError(f"Route uses unknown device {key}")
+        if route["input"] not in inputs:
+            inputs.append(route["input"])
+        if route["output"] not in outputs:
+            outputs.append(route["output"])
+        stages = []
+        for spec in route.get("stages", []):
+            key = (route["input"], route["output"], json.dumps(spec, sort_keys=True))
+            occurrence = 0
+            while key + (occurrence,) in stateful:
+                occurrence += 1
+            key += (occurrence,)
+            if previous is not None and key in previous.stateful:
+                stage = previous.stateful[key]
+            else:
+                stage = make_stage(config, spec)
+            if not stage.stateless:
+                stateful[key] = stage
+            stages.append(stage)
+        per_input.setdefault(route["input"], []).append((Pipeline(stages), outputs.index(route["output"])))
+
+    release = []
+    if previous is not None:
+        # Released through the port the stage played on, also when no route uses that output anymore
+        for key, stage in previous.stateful.items():
+            if key not in stateful and isinstance(stage, RoundRobin):
+                release.append((previous.output_ports[previous.outputs.index(key[1])], stage))
+    return Routes(inputs=tuple(inputs), outputs=tuple(outputs),
+                  routes=tuple(tuple(per_input[key]) for key in inputs), stateful=stateful, release=tuple(release))
+
+
+def open_input(name):
+    return devices.open_input(name, wait=True)
+
+
+def open_output(name):
+    return devices.open_output(name, wait=True)
+
+
+class Daemon:
+    """
+    Runs the routes of a config file. Devices are opened by name once and kept open over reloads, a device that is
+    missing or unplugged is picked up when it appears. open_input/open_output can be replaced, e.g. by virtual
+    devices.
+    """
+    def __init__(self, path, open_input=open_input, open_output=open_output, max_latency_us=MAX_LATENCY_US):
+        self.path = path
+        self.open_input = open_input
+        self.open_output = open_output
+        self.max_latency_us = max_latency_us
+        self.devices = {}  # device name -> opened port, per direction
+        self.lock = threading.Lock()  # guards devices, routes swaps and release
+        self.release = []  # (output port, removed stateful stage) of all reloads run() has not swapped in yet
+        self.stats = get_stats("daemon")
+        self.stats.extra["reloads"] = 0
+        self.stats.extra["reload_errors"] = 0
+        self.mtime = None
+        self.routes = None
+        self.reload()
+
+    def port(self, config, key, direction):
+        name = config["devices"][key]
+        if (name, direction) not in self.devices:
+            self.devices[name, direction] = (self.open_input if direction == "input" else self.open_output)(name)
+        return self.devices[name, direction]
+
+    def reload(self):
+        """Load the config and swap in the new routes, returns False and keeps the running routes on errors."""
+        with self.lock:
+            try:
+                self.mtime = os.stat(self.path).st_mtime_ns
+                config = load_config(self.path)
+                start = perf_counter_ns()
+                routes = build_routes(config, self.routes)
+                routes = routes._replace(input_ports=tuple(self.port(config, key, "input") for key in routes.inputs),
+                                         output_ports=tuple(self.port(config, key, "output") for key in routes.outputs))
+            except Exception as e:
+                print(f"Config {self.path} not loaded: {e}")
+                self.stats.extra["reload_errors"] += 1
+                return False
+            # Appended, not replaced: run() may not have swapped in the previous reload yet
+            self.release.extend(routes.release)
+            self.routes = routes
+        self.stats.extra["reloads"] += 1
+        self.stats.extra["build_us"] = (perf_counter_ns() - start) // 1000
+        print(f"Loaded {self.path}: {sum(len(r) for r in routes.routes)} routes from {len(routes.inputs)} inputs")
+        return True
+
+    def close_unused(self):
+        """Close the devices no route of the latest snapshot uses, after their notes were released."""
+        with self.lock:
+            used = {id(port) for port in self.routes.input_ports + self.routes.output_ports}
+            for key, port in list(self.devices.items()):
+                if id(port) not in used:
+                    del self.devices[key]
+                    port.close()
+
+    def watch(self, interval=0.5, stop=None):
+        """Reload the config from a daemon thread when its modification time changes."""
+        stop = stop or threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    changed = os.stat(self.path).st_mtime_ns != self.mtime
+                except OSError:
+                    continue
+                if changed:
+                    self.reload()
+
+        threading.Thread(target=run, name="ConfigWatch", daemon=True).start()
+        return stop
+
+    def run(self, stop=None):
+        idle = AdaptiveSleep(self.max_latency_us)
+        current = mux = None
+        while stop is None or not stop.is_set():
+            routes = self.routes  # one read of the snapshot per iteration
+            if routes is not current:
+                with self.lock:
+                    routes = self.routes
+                    release, self.release = self.release, []
+                if current is None or routes.input_ports != current.input_ports:
+                    mux = InputMux(routes.input_ports, max_latency_us=self.max_latency_us)
+                for port, stage in release:
+                    # The old stage is only touched by this thread, so its notes are released here
+                    note_offs = [[[(NOTE_OFF << 4) | channel, note, 0, 0], 0]
+                                 for channel, note in stage.voices.all_notes_off()]
+                    if note_offs:
+                        write_batch(port, note_offs)
+                self.close_unused()
+                current = routes
+            events = mux.read()
+            if not events:
+                idle.wait()
+                continue
+            idle.reset()
+            start = perf_counter_ns()
+            self.forward(routes, events)
+            self.stats.record_batch(start, len(events))
+
+    def forward(self, routes, events):
+        per_port = [[] for _ in routes.inputs]
+        for port, message in events:
+            per_port[port].append(message)
+        per_output = {}
+        for port, port_events in enumerate(per_port):
+            if port_events:
+                for pipeline, output in routes.routes[port]:
+                    result = pipeline.process_events(port_events)
+                    if result:
+                        per_output.setdefault(output, []).append(result)
+        for output, results in per_output.items():
+            batch = results[0] if len(results) == 1 else list(heapq.merge(*results, key=lambda event: event[1]))
+            write_batch(routes.output_ports[output], batch)
+            if message_log.enabled:
+                for message in batch:
+                    message_log.push(message, None, f"{routes.outputs[output]}: ")
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 1:
+        print("Usage: python -m transcoder.daemon routes.toml [--quiet|--verbose] [--stats[=dump.json]] "
+              "[--backend=pygame|rtmidi|alsa|jack] [--delay=ms]")
+        sys.exit(1)
+    if "--quiet" in sys.argv:
+        message_log.set_verbosity(VERBOSITY_OFF)
+    if "--verbose" in sys.argv:
+        message_log.set_verbosity(VERBOSITY_ALL)
+    for arg in sys.argv:
+        if arg.startswith("--stats"):
+            report_periodically(path=arg.split("=", 1)[1] if "=" in arg else None)
+
+    backend = get_backend(next((arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--backend=")), "pygame"))
+    delay_ms = next((int(arg.split("=", 1)[1]) for arg in sys.argv if arg.startswith("--delay=")), None)
+    daemon = Daemon(args[0], open_input=backend.open_input,
+                    open_output=lambda name: backend.open_output(name, delay_ms))
+    if daemon.routes is None:
+        sys.exit(1)
+    daemon.watch()
+    backend.watch()
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        message_log.stop()
@@ -20,18 +20,63 @@ drClass' MIDI Transcoder
 1) Transcode MIDI message from all enabled input channels to all enabled output channels
 2) Forward MIDI messages from input channel to output channel.
 3) A convenient GUI to enable or disable which channels are enabled.
+
+Usage: gui.py [--headless [--outputs=1,2]] [--stats[=dump.json]] [--profile] [--backend=pygame|rtmidi|alsa|jack]
+              [--delay=ms]
+
+PortMidi (with pygame) is imported and the devices are opened on the MIDI thread while the window is built.
+--headless forwards with the default routing (all inputs and thru channels, the outputs given) without Tk.
+--profile prints how long the imports, the device init and the window took, and when the first note was forwarded.
 """
+from time import perf_counter_ns
+STARTED_NS = perf_counter_ns()
 
-import tkinter as tk
 from threading import Event
-from tkinter import font
+from typing import NamedTuple, Tuple
 
-import pygame.midi as midi
+import sys
 import threading
-import time
 
-from transcoder.utils.midi import get_midi, choose_device_by_name, monitor_inputs, friendly_message, decode_message, \
-    encode_message, NOTE_OFF, NOTE_ON, number_to_full_note, full_note_to_number
+from transcoder.utils.midi import NOTE_OFF, NOTE_ON, number_to_full_note, full_note_to_number, InputMux, AdaptiveSleep, \
+    write_batch, LazyModule, midi
+from transcoder.utils.log import message_log
+from transcoder.utils.backends import get_backend
+from transcoder.utils.stats import get_stats, report_periodically
+
+tk = LazyModule("tkinter")
+font = LazyModule("tkinter.font")
+IMPORTED_NS = perf_counter_ns()
+
+
+class Routing(NamedTuple):
+    """
+    Immutable snapshot of the routing state in the UI, published by the Tk thread whenever a button changes.
+    Channels are bit masks, split ranges are note numbers [begin, end) and shift is the transpose in semitones.
+    fanout holds for every input note the (output channel, output note) pairs it is forwarded to.
+    """
+    inputs: int
+    outputs: int
+    thru: int
+    split_begin: Tuple[int, ...]
+    split_end: Tuple[int, ...]
+    transpose: Tuple[int, ...]
+    octave: bool
+    shift: Tuple[int, ...]
+    fanout: Tuple[Tuple[Tuple[int, int], ...], ...]
+
+
+def make_routing(inputs, outputs, thru, split_begin, split_end, transpose, octave) -> Routing:
+    shift = tuple(t * 12 if octave else t for t in transpose)
+    fanout = []
+    for note in range(128):
+        targets = []
+        for i in range(16):
+            if outputs >> i & 1 and split_begin[i] <= note < split_end[i] and 0 <= note + shift[i] < 128:
+                targets.append((i, note + shift[i]))
+        fanout.append(tuple(targets))
+    return Routing(inputs=inputs, outputs=outputs, thru=thru, split_begin=tuple(split_begin),
+                   split_end=tuple(split_end), transpose=tuple(transpose), octave=octave, shift=shift,
+                   fanout=tuple(fanout))
 
 
 class UI:
@@ -181,6 +226,41 @@ class UI:
             self.thru_buttons.append(thru_button)
             thru_button.grid(row=7, column=i + 10)
 
+        self.routing = None
+        self.publish_routing()
+
+    def publish_routing(self):
+        """Snapshot the widget state into a Routing, the MIDI thread only ever reads self.routing."""
+        def mask(buttons):
+            return sum(1 << i for i, b in enumerate(buttons) if b.cget("relief") == "sunken")
+
+        def split_note(button, default):
+            note_name = button.cget("text")
+            if button.cget("relief") == "sunken" and note_name != "X":
+                return full_note_to_number(note_name)
+            return default
+
+        self.routing = make_routing(inputs=mask(self.input_buttons),
+                                    outputs=mask(self.output_buttons),
+                                    thru=mask(self.thru_buttons),
+                                    split_begin=[split_note(b, 0) for b in self.split_begin_buttons],
+                                    split_end=[split_note(b, 128) for b in self.split_end_buttons],
+                                    transpose=self.transpose,
+                                    octave=self.transpose_octave_button.cget("relief") == "sunken")
+
+    def learn_split(self, note):
+        if self.split_begin_button_id is not None:
+            self.split_begin_buttons[self.split_begin_button_id].config(text=number_to_full_note(note))
+            self.disable_split_button("split_begin")
+            self.on_set_split("split_begin", "set")
+            self.split_begin_button_id = None
+        if self.split_end_button_id is not None:
+            self.split_end_buttons[self.split_end_button_id].config(text=number_to_full_note(note))
+            self.disable_split_button("split_end")
+            self.on_set_split("split_end", "set")
+            self.split_end_button_id = None
+        self.publish_routing()
+
     def on_all(self, button_type, switch):
         if button_type == "input":
             l = self.input_buttons
@@ -193,6 +273,7 @@ class UI:
                 b.config(relief="sunken", bg=self.on_color, fg="white")
             else:
                 b.config(relief="raised", bg=self.off_color, fg="black")
+        self.publish_routing()
 
     def disable_split_button(self, button_type):
         if button_type == "split_begin":
@@ -217,6 +298,7 @@ class UI:
         else:
             self.transpose_semitone_button.config(relief="sunken", bg=self.split_on_color, fg="white")
             self.transpose_octave_button.config(relief="raised", bg=self.split_off_color, fg="black")
+        self.publish_routing()
 
     def on_set_split(self, button_type, switch):
         if button_type == "split_begin" and switch == "set":
@@ -273,112 +355,182 @@ class UI:
                 button.config(relief="raised", bg=self.off_color, fg="black")
             else:
                 button.config(relief="sunken", bg=self.on_color, fg="white")
+        self.publish_routing()
+
+    def bind_devices(self, messages):
+        self.init_button.bind("<Button>", lambda x: messages.init_devices())
+        self.show_button.bind("<Button>", lambda x: messages.show_devices())
 
     def start(self):
         self.root.mainloop()
 
 
+class HeadlessUI:
+    """Stand-in for the UI without Tk, forwarding with a fixed routing."""
+    def __init__(self, routing: Routing):
+        self.routing = routing
+        self.split_begin_button_id = None
+        self.split_end_button_id = None
+
+    def bind_devices(self, messages):
+        pass
+
+
 class Messages:
-    def __init__(self, midi_thru_name, midi_input_name, midi_output_name, ui):
+    INPUT_PORT = 0
+
+    def __init__(self, midi_thru_name, midi_input_name, midi_output_name, ui=None, backend="pygame", delay_ms=None):
+        self.backend_name = backend
+        self.delay_ms = delay_ms
+        self.backend = None
         self.midi_input_name = midi_input_name
         self.midi_output_name = midi_output_name
-        self.midi_thru_name = midi_thru_name
-        self.midi_thru = None
+        self.midi_thru_names = [midi_thru_name] if isinstance(midi_thru_name, str) else list(midi_thru_name)
+        self.midi_thru = []
         self.midi_input = None
         self.midi_output = None
+        self.mux = None
         self.stop = Event()
-        self.initialized = False
+        self.initialized = Event()
+        self.stats = get_stats("gui")
+        self.startup = get_stats("startup").extra  # ms since the import of gui.py started
+        self.ui = None
+        self.ui_ready = Event()
+        if ui is not None:
+            self.set_ui(ui)
+
+    def set_ui(self, ui):
+        """The UI can be attached after the MIDI thread started, forwarding starts when it is."""
         self.ui = ui
-        self.ui.init_button.bind("<Button>", lambda x: self.init_devices())
-        self.ui.show_button.bind("<Button>", lambda x: self.show_devices())
+        self.ui.bind_devices(self)
+        self.ui_ready.set()
 
     def show_devices(self):
-        [print(d) for d in get_midi()]
+        if self.backend is not None:
+            [print(d) for d in self.backend.inputs() + self.backend.outputs()]
 
     def init_devices(self):
+        """Open the devices by name the first time, rescan and reopen them on later calls (the Init button)."""
+        if self.mux is not None:
+            self.backend.refresh()
+            return
         try:
-            midi.init()
-            devices = get_midi()
-            input_dev = choose_device_by_name(devices, self.midi_input_name, "input")
-            output_dev = choose_device_by_name(devices, self.midi_output_name, "output")
-            thru_dev = choose_device_by_name(devices, self.midi_thru_name, "input")
-
-            self.midi_thru = midi.Input(thru_dev["idx"])
-            self.midi_input = midi.Input(input_dev["idx"])
-            self.midi_output = midi.Output(output_dev["idx"])
-            self.initialized = True
+            if self.backend is None:
+                self.backend = get_backend(self.backend_name)
+            # With pygame missing devices are opened as soon as they are plugged in
+            self.midi_thru = [self.backend.open_input(name) for name in self.midi_thru_names]
+            self.midi_input = self.backend.open_input(self.midi_input_name)
+            self.midi_output = self.backend.open_output(self.midi_output_name, self.delay_ms)
         except RuntimeError as e:
             print(e)
-            self.initialized = False
+            return
+        self.startup["pygame_midi_ms"] = midi.import_ns / 1e6
+        # Port 0 is the keyboard input, the other ports are thru ports
+        self.mux = InputMux([self.midi_input] + self.midi_thru)
+        self.backend.watch(stop=self.stop)
+        self.startup["devices_ms"] = (perf_counter_ns() - STARTED_NS) / 1e6
+        self.initialized.set()
+
+    def forward(self, events):
+        routing = self.ui.routing
+        output_messages = []
+        for port, message in events:
+            (status, note, velo, _), timestamp = message
+            channel = status & 0x0F
+            cmd = status >> 4
+            if port == self.INPUT_PORT:
+                # Use note to set split point, the UI applies it on the Tk thread
+                if self.ui.split_begin_button_id is not None or self.ui.split_end_button_id is not None:
+                    self.ui.root.after(0, self.ui.learn_split, note)
+
+                # Fetch and forward note
+                if cmd in [NOTE_ON, NOTE_OFF] and routing.inputs >> channel & 1:
+                    status = cmd << 4
+                    for out_channel, out_note in routing.fanout[note]:
+                        output_message = ((status | out_channel, out_note, velo, 0), timestamp)
+                        output_messages.append(output_message)
+                        if message_log.enabled:
+                            message_log.push(message, output_message, "Forward: ")
+            elif routing.thru >> channel & 1:
+                output_messages.append(message)
+                if message_log.enabled and cmd in [NOTE_ON, NOTE_OFF]:
+                    message_log.push(message, None, "Thru: ")
+        if output_messages:
+            write_batch(self.midi_output, output_messages)
+            if "first_note_ms" not in self.startup:
+                self.startup["first_note_ms"] = (perf_counter_ns() - STARTED_NS) / 1e6
 
     def __call__(self):
         self.init_devices()
-
+        idle = AdaptiveSleep()
         while not self.stop.is_set():
-            if not self.initialized:
-                print(".", end="")
-                time.sleep(1)
+            if not self.initialized.is_set():
+                self.initialized.wait(0.1)
+                continue
+            if not self.ui_ready.is_set():
+                self.ui_ready.wait(0.1)
                 continue
+            events = self.mux.read()
+            if events:
+                start = perf_counter_ns()
+                idle.reset()
+                self.forward(events)
+                self.stats.record_batch(start, len(events))
+                self.stats.extra["received"] = self.mux.received
+                self.stats.extra["backlog"] = self.mux.backlog
+            else:
+                idle.wait()
 
-            if self.midi_input.poll():
-                message = self.midi_input.read(1)[0]
-                timestamp, channel, cmd, note, velo = decode_message(message)
-
-                # Use note to set split point
-                if self.ui.split_begin_button_id is not None:
-                    self.ui.split_begin_buttons[self.ui.split_begin_button_id].config(text=number_to_full_note(note))
-                    self.ui.disable_split_button("split_begin")
-                    self.ui.on_set_split("split_begin", "set")
-                    self.ui.split_begin_button_id = None
-                if self.ui.split_end_button_id is not None:
-                    self.ui.split_end_buttons[self.ui.split_end_button_id].config(text=number_to_full_note(note))
-                    self.ui.disable_split_button("split_end")
-                    self.ui.on_set_split("split_end", "set")
-                    self.ui.split_end_button_id = None
 
-                # Fetch and forward note
-                if cmd in [NOTE_ON, NOTE_OFF] and self.ui.input_buttons[channel].cget("relief") == "sunken":
-                    for i in range(16):
-                        if self.ui.output_buttons[i].cget("relief") == "sunken":
-                            min_note = 0
-                            if self.ui.split_begin_buttons[i].cget("relief") == "sunken":
-                                note_name = self.ui.split_begin_buttons[i].cget("text")
-                                if note_name != "X":
-                                    min_note = full_note_to_number(note_name)
-                            max_note = 999
-                            if self.ui.split_end_buttons[i].cget("relief") == "sunken":
-                                note_name = self.ui.split_end_buttons[i].cget("text")
-                                if note_name != "X":
-                                    max_note = full_note_to_number(note_name)
-                            if min_note <= note < max_note:
-                                if self.ui.transpose_octave_button.cget("relief") == "sunken":
-                                    note += self.ui.transpose[i] * 12
-                                else:
-                                    note += self.ui.transpose[i]
-                                output_message = encode_message(timestamp, i, cmd, note, velo)
-                                self.midi_output.write([output_message])
-                                print(f"Forward: {friendly_message(message)} -> {friendly_message(output_message)}")
-
-            if self.midi_thru.poll():
-                message = self.midi_thru.read(1)[0]
-                timestamp, channel, cmd, note, velo = decode_message(message)
-                if self.ui.thru_buttons[channel].cget("relief") == "sunken":
-                    self.midi_output.write([message])
-                    if cmd in [NOTE_ON, NOTE_OFF]:
-                        print(f"Thru: {friendly_message(message)}")
-            time.sleep(0)
+def print_startup(startup):
+    print("Startup ms: " + " ".join(f"{key}: {value:.1f}" for key, value in startup.items()))
+
+
+def headless_routing(outputs):
+    """The routing the UI starts with: all input and thru channels, split off, transposition off."""
+    return make_routing(inputs=0xFFFF, outputs=outputs, thru=0xFFFF, split_begin=[0] * 16, split_end=[128] * 16,
+                        transpose=[0] * 16, octave=True)
 
 
 if __name__ == "__main__":
-    ui = UI()
+    outputs = 0
+    for arg in sys.argv:
+        if arg.startswith("--stats"):
+            report_periodically(path=arg.split("=", 1)[1] if "=" in arg else None)
+        if arg.startswith("--outputs="):
+            outputs = sum(1 << (int(channel) - 1) for channel in arg.split("=", 1)[1].split(","))
     message_handler = Messages(midi_thru_name="UM-ONE",
                                midi_input_name="Roland Digital Piano",
                                midi_output_name="UM-ONE",
-                               ui=ui)
-    # # Create a thread for MIDI forwarding
+                               backend=next((arg.split("=", 1)[1] for arg in sys.argv
+                                             if arg.startswith("--backend=")), "pygame"),
+                               delay_ms=next((int(arg.split("=", 1)[1]) for arg in sys.argv
+                                              if arg.startswith("--delay=")), None))
+    startup = message_handler.startup
+    startup["imports_ms"] = (IMPORTED_NS - STARTED_NS) / 1e6
+    # Create a thread for MIDI forwarding, it imports PortMidi and opens the devices while the window is built
     midi_thread = threading.Thread(target=message_handler)
     midi_thread.start()
-    message_handler.ui.start()
+    if "--headless" in sys.argv:
+        message_handler.set_ui(HeadlessUI(headless_routing(outputs)))
+        if "--profile" in sys.argv:
+            message_handler.initialized.wait(10)
+            print_startup(startup)
+        try:
+            while midi_thread.is_alive():
+                midi_thread.join(0.5)
+        except KeyboardInterrupt:
+            pass
+    else:
+        ui = UI()
+        message_handler.set_ui(ui)
+        startup["window_ms"] = (perf_counter_ns() - STARTED_NS) / 1e6
+        if "--profile" in sys.argv:
+            ui.root.after(0, lambda: print_startup(startup))
+        ui.start()
     message_handler.stop.set()
     midi_thread.join()
+    message_log.stop()
+    if "--profile" in sys.argv:
+        print_startup(startup)
     print("Closed")
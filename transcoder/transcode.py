@@ -23,13 +23,16 @@ drClass' MIDI Transcoder
 4) Transcode Guitar Hero Drums to Electron Model Cycles
 """
 import sys
-import time
-from typing import Dict, List, Any
+from time import perf_counter_ns
 
-import pygame.midi as midi
-
-from transcoder.utils.midi import get_midi_input, get_midi_output, choose_device_by_name, choose_device, encode_message, \
-    decode_note_message, NOTE_ON, NOTE_OFF, decode_message, full_note_to_number, friendly_message
+from transcoder.utils.midi import choose_device, encode_message, \
+    NOTE_ON, NOTE_OFF, decode_message, full_note_to_number, TranscodeMap, \
+    pump_events, MAX_LATENCY_US, MessageBatch, time_ms
+from transcoder.utils.log import message_log, VERBOSITY_OFF, VERBOSITY_ALL
+from transcoder.utils.pipeline import Pipeline, Remap, RoundRobin, run_callback
+from transcoder.utils.voices import ROUND_ROBIN
+from transcoder.utils.stats import get_stats, report_periodically
+from transcoder.utils.backends import get_backend
 
 # Band hero drums
 BH_CHANNEL = 9
@@ -50,111 +53,133 @@ VB_CL_HAT = 42
 VB_OP_HAT = 46
 VB_CLAP = 39
 
-
-def transcode_message(message, conv):
-    timestamp, channel, cmd, note, velo = decode_message(message)
-    result = message
-    if cmd in [NOTE_ON, NOTE_OFF]:
-        for channel_from, note_from, channel_to, note_to in conv:
-            if note == note_from and channel == channel_from:
-                result = encode_message(timestamp, channel_to, cmd, note_to, velo)
-    return result
-
-
-def message_transcode_loop(midi_input, midi_output, conv):
-    while True:
-        if midi_input.poll():
-            in_message = midi_input.read(1)[0]
-            out_message = transcode_message(in_message, conv)
-            midi_output.write([out_message])
-            print(f"{friendly_message(in_message)} -> {friendly_message(out_message)}")
-
-
-def message_copy_loop(midi_input, midi_output):
-    while True:
-        if midi_input.poll():
-            message = midi_input.read(1)[0]
-            midi_output.write([message])
-            print(f"{friendly_message(message)}")
-
-def band_hero_to_volca_beats(midi_input, midi_output):
-    conv = [[BH_CHANNEL, BH_BASS,      VB_CHANNEL, VB_KICK],
+BH_TO_VB = [[BH_CHANNEL, BH_BASS,      VB_CHANNEL, VB_KICK],
             [BH_CHANNEL, BH_RED_TOM,   VB_CHANNEL, VB_SNARE],
             [BH_CHANNEL, BH_BLUE_TOM,  VB_CHANNEL, VB_HI_TOM],
             [BH_CHANNEL, BH_GREEN_TOM, VB_CHANNEL, VB_LO_TOM],
             [BH_CHANNEL, BH_YELLOW_HI, VB_CHANNEL, VB_CL_HAT],
             [BH_CHANNEL, BH_ORANGE_HI, VB_CHANNEL, VB_OP_HAT]]
-    message_transcode_loop(midi_input, midi_output, conv)
-
 
-def band_hero_to_electron_cycles(midi_input, midi_output):
-    conv = [[BH_CHANNEL, BH_BASS,      0, full_note_to_number("C5")],
+# Elektron Model Cycles, one track (channel) per pad
+BH_TO_MC = [[BH_CHANNEL, BH_BASS,      0, full_note_to_number("C5")],
             [BH_CHANNEL, BH_RED_TOM,   1, full_note_to_number("C5")],
             [BH_CHANNEL, BH_BLUE_TOM,  2, full_note_to_number("C5")],
             [BH_CHANNEL, BH_GREEN_TOM, 3, full_note_to_number("C5")],
             [BH_CHANNEL, BH_YELLOW_HI, 4, full_note_to_number("C5")],
             [BH_CHANNEL, BH_ORANGE_HI, 5, full_note_to_number("C5")]]
-    message_transcode_loop(midi_input, midi_output, conv)
-
-
-def round_robin_notes(midi_input, midi_output, in_channel, out_channels, echo_other=True):
-    idx = 0
-    note_state = {}
-    while True:
-        if midi_input.poll():
-            in_message = midi_input.read(1)[0]
-            timestamp, chan, cmd, byte1, byte2 = decode_message(in_message)
-            if chan == in_channel and cmd in [NOTE_ON, NOTE_OFF]:
-                if cmd == NOTE_ON:
-                    out_message = encode_message(timestamp, out_channels[idx], cmd, byte1, byte2)
-                    state, oct, note, _ = decode_note_message(cmd, byte1, byte2)
-                    note_state[f"{note}{oct}"] = out_channels[idx]  # remember which channel to note belongs to
-                    idx = (idx + 1 if idx < len(out_channels) - 1 else 0)
-                else:
-                    state, oct, note, _ = decode_note_message(cmd, byte1, byte2)
-                    out_channel = note_state[f"{note}{oct}"]
-                    out_message = encode_message(timestamp, out_channel, cmd, byte1, byte2)
-                    del note_state[f"{note}{oct}"]
-
-                midi_output.write([out_message])
-                print(f"{friendly_message(in_message)} -> {friendly_message(out_message)}")
-                print(note_state)
-            elif echo_other:
-                midi_output.write([in_message])
+
+
+def transcode_message(message, conv: TranscodeMap):
+    """Transcode one message, compile the rules into a TranscodeMap once and pass that for every message."""
+    timestamp, channel, cmd, note, velo = decode_message(message)
+    if cmd in [NOTE_ON, NOTE_OFF]:
+        dest = conv.table[(channel << 7) | note]
+        if dest != (channel << 7) | note:
+            return encode_message(timestamp, dest >> 7, cmd, dest & 0x7F, velo)
+    return message
+
+
+def message_transcode_loop(midi_input, midi_output, conv, max_latency_us=MAX_LATENCY_US):
+    if not isinstance(conv, TranscodeMap):
+        conv = TranscodeMap(conv)
+    stats = get_stats("transcode")
+    for in_batch in pump_events(midi_input, max_latency_us=max_latency_us):
+        start = perf_counter_ns()
+        stats.age_ms.record(max(time_ms() - in_batch[0][1], 0))
+        batch = MessageBatch.from_events(in_batch)
+        stats.unmatched += batch.transcode(conv)
+        out_batch = batch.to_events()
+        midi_output.write(out_batch)
+        stats.record_batch(start, len(in_batch))
+        if message_log.enabled:
+            for in_message, out_message in zip(in_batch, out_batch):
+                message_log.push(in_message, out_message)
+
+
+def message_copy_loop(midi_input, midi_output, max_latency_us=MAX_LATENCY_US):
+    stats = get_stats("copy")
+    for batch in pump_events(midi_input, max_latency_us=max_latency_us):
+        start = perf_counter_ns()
+        stats.age_ms.record(max(time_ms() - batch[0][1], 0))
+        midi_output.write(batch)
+        stats.record_batch(start, len(batch))
+        if message_log.enabled:
+            for message in batch:
+                message_log.push(message)
+
+def band_hero_to_volca_beats(midi_input, midi_output):
+    message_transcode_loop(midi_input, midi_output, TranscodeMap(BH_TO_VB))
+
+
+def band_hero_to_electron_cycles(midi_input, midi_output):
+    message_transcode_loop(midi_input, midi_output, TranscodeMap(BH_TO_MC))
+
+
+def round_robin_notes(midi_input, midi_output, in_channel, out_channels, echo_other=True, policy=ROUND_ROBIN,
+                      polyphony=1, max_latency_us=MAX_LATENCY_US):
+    voices = RoundRobin(in_channel, out_channels, echo_other=echo_other, policy=policy, polyphony=polyphony)
+    stats = get_stats("round_robin")
+    for in_batch in pump_events(midi_input, max_latency_us=max_latency_us):
+        start = perf_counter_ns()
+        stats.age_ms.record(max(time_ms() - in_batch[0][1], 0))
+        out_batch = voices.process(MessageBatch.from_events(in_batch)).to_events()
+        if out_batch:
+            midi_output.write(out_batch)
+            if message_log.enabled:
+                for out_message in out_batch:
+                    message_log.push(out_message, None, "Voice: ")
+        stats.record_batch(start, len(in_batch))
+        stats.unmatched = voices.voices.unmatched
+        stats.extra["stolen"] = voices.voices.stolen
 
 if __name__ == "__main__":
-    midi.init()
-    input_devices = get_midi_input()
-    output_devices = get_midi_output()
-    if len(sys.argv) == 3:
-        input_device_name = sys.argv[1]
-        output_device_name = sys.argv[2]
-        input_device = choose_device_by_name(input_devices, sys.argv[1])
-        output_device = choose_device_by_name(output_devices, sys.argv[2])
+    # Usage: transcode.py [input_name output_name] [--quiet|--verbose] [--stats[=dump.json]]
+    #                     [--backend=pygame|rtmidi|alsa|jack] [--delay=ms]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--quiet" in sys.argv:
+        message_log.set_verbosity(VERBOSITY_OFF)
+    if "--verbose" in sys.argv:
+        message_log.set_verbosity(VERBOSITY_ALL)
+    for arg in sys.argv:
+        if arg.startswith("--stats"):
+            report_periodically(path=arg.split("=", 1)[1] if "=" in arg else None)
+
+    backend = get_backend(next((arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--backend=")), "pygame"))
+    if len(args) == 2:
+        input_name, output_name = args
     else:
-        input_device = choose_device(input_devices, "input")
-        output_device = choose_device(output_devices, "output")
-
-    print(f"Chosen input: {input_device['name']}")
-    print(f"Chosen output: {output_device['name']}")
+        input_name = choose_device(backend.inputs(), "input")["name"]
+        output_name = choose_device(backend.outputs(), "output")["name"]
+
+    print(f"Chosen input: {input_name}")
+    print(f"Chosen output: {output_name}")
+    # With pygame the ports survive unplugging the devices, they are reopened when the devices reappear
+    midi_input = backend.open_input(input_name)
+    # With --delay every message leaves at its input time plus the delay, keeping the timing under bursts
+    delay_ms = next((int(arg.split("=", 1)[1]) for arg in sys.argv if arg.startswith("--delay=")), None)
+    midi_output = backend.open_output(output_name, delay_ms)
+    backend.watch()
 
     # Simple MIDI monitor
-    # monitor_inputs(midi.Input(input_device["idx"]))
+    # monitor_inputs(midi_input)
 
     # Copy Input to Output
-    # message_copy_loop(midi.Input(input_device["idx"]),
-    #                   midi.Output(output_device["idx"]))
+    # message_copy_loop(midi_input, midi_output)
 
-    # Transcode Band Hero to Volca Beats
-    band_hero_to_volca_beats(midi.Input(input_device["idx"]),
-                             midi.Output(output_device["idx"]))
+    # Transcode Band Hero to Volca Beats, from the backend's thread when it calls back
+    if backend.callbacks:
+        run_callback(Pipeline([Remap(BH_TO_VB)]), midi_input, midi_output)
+    else:
+        band_hero_to_volca_beats(midi_input, midi_output)
 
     # Transcode Band Hero to Model Cycles
-    # band_hero_to_electron_cycles(midi.Input(input_device["idx"]),
-    #                              midi.Output(output_device["idx"]))
+    # band_hero_to_electron_cycles(midi_input, midi_output)
 
     # Round robin notes to create a polyphonic Model Cycles
-    # round_robin_notes(midi.Input(input_device["idx"]),
-    #                   midi.Output(output_device["idx"]),
+    # round_robin_notes(midi_input, midi_output,
     #                   in_channel=8,
     #                   out_channels=[0, 1, 2, 3])
+
+    # Pipeline: Only the Band Hero channel, transcode to Volca Beats and add a velocity CC
+    # run_pipeline([Pipeline([Filter(channels=1 << BH_CHANNEL), Remap(BH_TO_VB), VelocityCC(cc=41)])],
+    #              [midi_input], midi_output)
@@ -0,0 +1,450 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI backends
+
+Every backend opens ports by name that behave like pygame.midi ports: inputs have poll() and read(num_events),
+outputs have write(events), all in PortMidi format ([[status, data1, data2, 0], timestamp]), so pump_events,
+InputMux and write_batch work on any of them. Timestamps are in ms on the backend clock, time_ms() follows the
+backend that was created last.
+
+    pygame  PortMidi through pygame.midi, polling only (Windows, Linux, macOS)
+    rtmidi  python-rtmidi, callback driven (ALSA sequencer with "alsa", also CoreMIDI and WinMM)
+    jack    a JACK client with one port per name, callback driven from the JACK process thread
+
+Inputs of callback driven backends (callbacks = True) also have set_callback(fn): fn(events) is then called from
+the backend's thread for every incoming batch instead of queueing the events for read(). See run_callback() in
+utils/pipeline.py. python-rtmidi and JACK-Client are only imported when their backend is used.
+
+open_output(name, delay_ms) schedules every written event at its (input) timestamp plus delay_ms, see
+ScheduledOutput.
+"""
+import bisect
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+from transcoder.utils.midi import LazyModule, midi, set_clock
+from transcoder.utils.devices import devices
+from transcoder.utils.pipeline import message_length
+from transcoder.utils.stats import get_stats
+
+rtmidi = LazyModule("rtmidi")
+jack = LazyModule("jack")
+
+
+class ScheduledOutput:
+    """
+    Sends every event at its timestamp plus delay_ms on the backend clock: a constant latency instead of the clumps
+    a loop that falls behind in a burst writes. When the port times the events itself (timed, PortMidi with a
+    latency or JACK frame offsets) write() passes the events on, otherwise a thread dispatches them from a heap.
+
+    The "schedule" stats record the slack of every event: the ms it had left until its deadline when it was written.
+    Late events (slack below zero) are sent right away and counted in late_ms.
+    """
+    def __init__(self, output, delay_ms, clock, timed=False, stats_name="schedule"):
+        self.output = output
+        self.delay_ms = delay_ms
+        self.clock = clock
+        self.timed = timed
+        self.stats = get_stats(stats_name)
+        self.stats.extra.setdefault("late", 0)
+        self.slack_ms = self.stats.histogram("slack_ms")
+        self.late_ms = self.stats.histogram("late_ms")
+        if not timed:
+            self.heap = []
+            self.seq = itertools.count()
+            self.condition = threading.Condition()
+            self.closed = False
+            self.thread = threading.Thread(target=self.run, name="ScheduledOutput", daemon=True)
+            self.thread.start()
+
+    def write(self, events):
+        now = self.clock()
+        delay = self.delay_ms
+        late = 0
+        for message, timestamp in events:
+            slack = timestamp + delay - now
+            if slack >= 0:
+                self.slack_ms.record(slack)
+            else:
+                self.late_ms.record(-slack)
+                late += 1
+        self.stats.messages += len(events)
+        self.stats.extra["late"] += late
+        if self.timed:
+            self.output.write(events)
+            return
+        with self.condition:
+            for message, timestamp in events:
+                heapq.heappush(self.heap, (timestamp + delay, next(self.seq), message))
+            self.condition.notify()
+
+    def write_short(self, status, data1=0, data2=0):
+        self.write([[[status, data1, data2, 0], self.clock()]])
+
+    def run(self):
+        heap = self.heap
+        while True:
+            with self.condition:
+                while not heap and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                now = self.clock()
+                if heap[0][0] > now:
+                    self.condition.wait((heap[0][0] - now) / 1000)
+                    continue
+                batch = []
+                while heap and heap[0][0] <= now:
+                    deadline, _, message = heapq.heappop(heap)
+                    batch.append([message, deadline])
+            self.output.write(batch)
+
+    def close(self):
+        """Stop the dispatch thread, send what is still pending right away (so no note hangs) and close the port."""
+        if not self.timed:
+            with self.condition:
+                self.closed = True
+                self.condition.notify()
+            self.thread.join()
+            pending = [[message, deadline] for deadline, _, message in sorted(self.heap)]
+            self.heap.clear()
+            if pending:
+                self.output.write(pending)
+        self.output.close()
+
+
+class Backend:
+    name = None
+    callbacks = False
+
+    def inputs(self):
+        """Device infos ({"name": ..., "iface": ...}) of the available inputs."""
+        raise NotImplementedError
+
+    def outputs(self):
+        raise NotImplementedError
+
+    def open_input(self, name):
+        raise NotImplementedError
+
+    def open_output(self, name, delay_ms=None):
+        """Without delay_ms events are sent when written, with it at their timestamp plus delay_ms."""
+        raise NotImplementedError
+
+    def time(self):
+        raise NotImplementedError
+
+    def refresh(self):
+        """Rescan the devices, where the backend needs it."""
+
+    def watch(self, stop=None):
+        """Reconnect devices in the background, where the backend needs it."""
+
+    def close(self):
+        pass
+
+
+class QueuedInput:
+    """Input filled by a backend thread: events queue up for poll()/read() until a callback is set."""
+    def __init__(self, name):
+        self.name = name
+        self.pending = collections.deque()
+        self.callback = None
+
+    def deliver(self, events):
+        callback = self.callback
+        if callback is not None:
+            callback(events)
+        else:
+            self.pending.extend(events)
+
+    def set_callback(self, callback):
+        """Call callback(events) from the backend's thread, None to queue the events for read() again."""
+        self.callback = callback
+
+    def poll(self):
+        return len(self.pending) > 0
+
+    def read(self, num_events):
+        pending = self.pending
+        return [pending.popleft() for _ in range(min(num_events, len(pending)))]
+
+    def close(self):
+        pass
+
+
+class PygameBackend(Backend):
+    """pygame.midi through the device registry, so ports reconnect after a replug."""
+    name = "pygame"
+
+    def inputs(self):
+        return devices.inputs
+
+    def outputs(self):
+        return devices.outputs
+
+    def open_input(self, name):
+        return devices.open_input(name, wait=True)
+
+    def open_output(self, name, delay_ms=None):
+        if not delay_ms:
+            return devices.open_output(name, wait=True)
+        # PortMidi sends timestamped writes at timestamp + latency on its own
+        return ScheduledOutput(devices.open_output(name, wait=True, latency=delay_ms), delay_ms, self.time,
+                               timed=True)
+
+    def time(self):
+        return midi.time()
+
+    def refresh(self):
+        devices.refresh()
+
+    def watch(self, stop=None):
+        return devices.watch(stop=stop)
+
+
+class RtMidiInput(QueuedInput):
+    def __init__(self, name, midi_in, clock):
+        super().__init__(name)
+        self.midi_in = midi_in
+        self.clock = clock
+        midi_in.ignore_types(sysex=False, timing=True, active_sense=True)
+        midi_in.set_callback(self.on_message)
+
+    def on_message(self, event, data=None):
+        message, _ = event
+        if len(message) <= 3:
+            self.deliver([[list(message) + [0] * (4 - len(message)), self.clock()]])
+
+    def close(self):
+        self.midi_in.close_port()
+
+
+class RtMidiOutput:
+    def __init__(self, name, midi_out):
+        self.name = name
+        self.midi_out = midi_out
+
+    def write(self, events):
+        send = self.midi_out.send_message
+        for message, _ in events:
+            send(message[:message_length(message[0])])
+
+    def write_short(self, status, data1=0, data2=0):
+        self.midi_out.send_message([status, data1, data2][:message_length(status)])
+
+    def close(self):
+        self.midi_out.close_port()
+
+
+class RtMidiBackend(Backend):
+    """python-rtmidi, api is "alsa", "jack", "coremidi", "winmm" or None for the platform default."""
+    name = "rtmidi"
+    callbacks = True
+    APIS = {"alsa": "API_LINUX_ALSA", "jack": "API_UNIX_JACK", "coremidi": "API_MACOSX_CORE",
+            "winmm": "API_WINDOWS_MM"}
+
+    def __init__(self, api=None, client_name="MIDITools"):
+        self.api = getattr(rtmidi, self.APIS[api]) if api is not None else rtmidi.API_UNSPECIFIED
+        self.client_name = client_name
+        self.start = time.perf_counter()
+        set_clock(self.time)
+
+    def time(self):
+        return int((time.perf_counter() - self.start) * 1000)
+
+    def ports(self, port_type):
+        return port_type(self.api, name=self.client_name).get_ports()
+
+    def inputs(self):
+        return [{"idx": i, "iface": self.name, "name": name} for i, name in enumerate(self.ports(rtmidi.MidiIn))]
+
+    def outputs(self):
+        return [{"idx": i, "iface": self.name, "name": name} for i, name in enumerate(self.ports(rtmidi.MidiOut))]
+
+    def open_port(self, port_type, name):
+        port = port_type(self.api, name=self.client_name)
+        # rtmidi port names carry the client and port numbers, e.g. "UM-ONE:UM-ONE MIDI 1 20:0"
+        for idx, port_name in enumerate(port.get_ports()):
+            if port_name == name or port_name.startswith(name):
+                port.open_port(idx)
+                return port
+        raise RuntimeError(f"Device named {name} not found")
+
+    def open_input(self, name):
+        return RtMidiInput(name, self.open_port(rtmidi.MidiIn, name), self.time)
+
+    def open_output(self, name, delay_ms=None):
+        output = RtMidiOutput(name, self.open_port(rtmidi.MidiOut, name))
+        return output if delay_ms is None else ScheduledOutput(output, delay_ms, self.time)
+
+
+class JackOutput:
+    """
+    Events written from any thread are sent in the next JACK period, or with delay_frames at the frame of their
+    timestamp plus delay_frames. frames holds the frames of the recent JACK input events by their ms timestamp (see
+    JackBackend.process), the n-th of a run of events with the same timestamp is sent at the n-th of its frames. Other
+    timestamps map onto the first frame of their ms.
+    """
+    def __init__(self, name, port, samplerate, delay_frames=None, frames=None):
+        self.name = name
+        self.port = port
+        self.samplerate = samplerate
+        self.delay_frames = delay_frames
+        self.frames = {} if frames is None else frames
+        self.previous = None, 0  # timestamp of the last event scheduled and its index in the run of that timestamp
+        self.pending = collections.deque()
+        self.heap = []
+        self.seq = itertools.count()
+
+    def write(self, events):
+        self.pending.extend(events)
+
+    def write_short(self, status, data1=0, data2=0):
+        self.pending.append([[status, data1, data2, 0], 0])
+
+    def flush(self, base, frames):
+        port = self.port
+        port.clear_buffer()
+        pending = self.pending
+        if self.delay_frames is None:
+            while pending:
+                message, _ = pending.popleft()
+                port.write_midi_event(0, bytes(message[:message_length(message[0])]))
+            return
+        heap = self.heap
+        previous, index = self.previous
+        while pending:
+            message, timestamp = pending.popleft()
+            index = index + 1 if timestamp == previous else 0
+            previous = timestamp
+            known = self.frames.get(timestamp)
+            frame = known[min(index, len(known) - 1)] if known else timestamp * self.samplerate // 1000
+            heapq.heappush(heap, (frame + self.delay_frames, next(self.seq), message))
+        self.previous = previous, index
+        # JACK requires events in frame order, late events go out at the start of the period
+        end = base + frames
+        offset = 0
+        while heap and heap[0][0] < end:
+            frame, _, message = heapq.heappop(heap)
+            offset = max(frame - base, offset)
+            port.write_midi_event(offset, bytes(message[:message_length(message[0])]))
+
+    def close(self):
+        pass
+
+
+class JackBackend(Backend):
+    """
+    A JACK client registering one MIDI port per opened name. When name is an existing JACK port (e.g.
+    "a2j:UM-ONE [20] (capture): UM-ONE MIDI 1") the new port is connected to it, otherwise connect it with
+    jack_connect or a patchbay. Timestamps are the JACK frame time of the event in ms. The frames of the input
+    events of the last FRAMES_MS ms are kept by their timestamp, so a delayed output sends them delay_ms after their
+    exact frame instead of after the start of their ms.
+    """
+    name = "jack"
+    callbacks = True
+    FRAMES_MS = 1000
+
+    def __init__(self, client_name="MIDITools"):
+        self.client = jack.Client(client_name)
+        self.in_ports = []
+        self.out_ports = []
+        self.frames = {}  # ms timestamp of a recent input event -> the frames of the events with that timestamp
+        self.frame_times = collections.deque()  # the timestamps in frames, oldest first
+        self.client.set_process_callback(self.process)
+        self.client.activate()
+        set_clock(self.time)
+
+    def time(self):
+        return self.client.frame_time * 1000 // self.client.samplerate
+
+    def process(self, frames):
+        base = self.client.last_frame_time
+        samplerate = self.client.samplerate
+        recent, frame_times = self.frames, self.frame_times
+        horizon = base * 1000 // samplerate - self.FRAMES_MS
+        while frame_times and frame_times[0] < horizon:
+            del recent[frame_times.popleft()]
+        for midi_input in self.in_ports:
+            events = []
+            for offset, data in midi_input.port.incoming_midi_events():
+                if len(data) <= 3:
+                    message = list(bytes(data))
+                    frame = base + offset
+                    timestamp = frame * 1000 // samplerate
+                    if timestamp in recent:
+                        bisect.insort(recent[timestamp], frame)
+                    else:
+                        recent[timestamp] = [frame]
+                        frame_times.append(timestamp)
+                    events.append([message + [0] * (4 - len(message)), timestamp])
+            if events:
+                midi_input.deliver(events)
+        for midi_output in self.out_ports:
+            midi_output.flush(base, frames)
+
+    def jack_ports(self, is_output):
+        return [{"idx": i, "iface": self.name, "name": port.name}
+                for i, port in enumerate(self.client.get_ports(is_midi=True, is_output=is_output))
+                if not port.name.startswith(self.client.name + ":")]
+
+    def inputs(self):
+        return self.jack_ports(is_output=True)
+
+    def outputs(self):
+        return self.jack_ports(is_output=False)
+
+    def port_name(self, name):
+        return name.split(":")[-1].strip().replace(" ", "_") or "port"
+
+    def open_input(self, name):
+        port = self.client.midi_inports.register(self.port_name(name))
+        midi_input = QueuedInput(name)
+        midi_input.port = port
+        if any(info["name"] == name for info in self.inputs()):
+            self.client.connect(name, port)
+        self.in_ports.append(midi_input)
+        return midi_input
+
+    def open_output(self, name, delay_ms=None):
+        port = self.client.midi_outports.register(self.port_name(name))
+        samplerate = self.client.samplerate
+        midi_output = JackOutput(name, port, samplerate,
+                                 None if delay_ms is None else delay_ms * samplerate // 1000, self.frames)
+        if any(info["name"] == name for info in self.outputs()):
+            self.client.connect(port, name)
+        self.out_ports.append(midi_output)
+        return midi_output if delay_ms is None else ScheduledOutput(midi_output, delay_ms, self.time, timed=True)
+
+    def close(self):
+        self.client.deactivate()
+        self.client.close()
+
+
+BACKENDS = {"pygame": PygameBackend, "rtmidi": RtMidiBackend, "alsa": lambda: RtMidiBackend(api="alsa"),
+            "jack": JackBackend}
+
+
+def get_backend(name="pygame") -> Backend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown MIDI backend {name}, choose from {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
@@ -0,0 +1,153 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI batch transforms
+
+Vectorized versions of the realtime transforms in transcoder.utils.midi for offline event streams. An event stream
+is four equally long NumPy arrays: status, data1, data2 (uint8) and timestamp. Every function returns new arrays
+and produces the same bytes as the matching MessageBatch method.
+
+Run this file, or the batch scenarios of benchmarks.bench, to benchmark against the per-message path.
+"""
+import numpy as np
+
+from transcoder.utils.midi import MessageBatch, TranscodeMap
+
+
+def from_batch(batch: MessageBatch):
+    messages = np.frombuffer(batch.messages, dtype=np.uint32)
+    return ((messages & 0xFF).astype(np.uint8), ((messages >> 8) & 0xFF).astype(np.uint8),
+            ((messages >> 16) & 0xFF).astype(np.uint8), np.frombuffer(batch.timestamps, dtype=np.uint32).copy())
+
+
+def to_batch(status, data1, data2, timestamp) -> MessageBatch:
+    batch = MessageBatch()
+    messages = status.astype(np.uint32) | data1.astype(np.uint32) << 8 | data2.astype(np.uint32) << 16
+    batch.messages.frombytes(messages.astype(np.uint32).tobytes())
+    batch.timestamps.frombytes(np.asarray(timestamp, dtype=np.uint32).tobytes())
+    return batch
+
+
+def is_note(status):
+    """NOTE_ON or NOTE_OFF"""
+    return status & 0xE0 == 0x80
+
+
+def is_channel_message(status):
+    return status & 0xF0 != 0xF0
+
+
+def transcode(status, data1, conv: TranscodeMap):
+    """Remap channel and note of note messages through the 16x128 table of a TranscodeMap, see MessageBatch.transcode"""
+    table = np.asarray(conv.table, dtype=np.uint16)
+    notes = is_note(status)
+    dest = table[(status & 0x0F).astype(np.uint16) << 7 | (data1 & 0x7F)]
+    new_status = np.where(notes, (status & 0xF0) | (dest >> 7).astype(np.uint8), status).astype(np.uint8)
+    new_data1 = np.where(notes, (dest & 0x7F).astype(np.uint8), data1).astype(np.uint8)
+    return new_status, new_data1
+
+
+def remap_channels(status, channel_map):
+    """Give every channel message the channel from the 16 entry channel_map, see MessageBatch.set_channel"""
+    lut = np.asarray(channel_map, dtype=np.uint8)
+    return np.where(is_channel_message(status), (status & 0xF0) | lut[status & 0x0F], status).astype(np.uint8)
+
+
+def transpose(status, data1, semitones, channels=0xFFFF):
+    """Transpose note and aftertouch messages on the channels in the bit mask, see MessageBatch.transpose"""
+    selected = (is_note(status) | (status & 0xF0 == 0xA0)) & ((channels >> (status & 0x0F).astype(np.int64)) & 1 == 1)
+    shifted = np.clip((data1 & 0x7F).astype(np.int16) + semitones, 0, 127).astype(np.uint8)
+    return np.where(selected, shifted, data1).astype(np.uint8)
+
+
+def velocity_curve(status, data2, curve):
+    """Map NOTE_ON velocities above 0 through a 128 entry curve, see MessageBatch.velocity_curve"""
+    lut = np.asarray(curve, dtype=np.uint8)
+    selected = (status & 0xF0 == 0x90) & (data2 & 0x7F != 0)
+    return np.where(selected, lut[data2 & 0x7F], data2).astype(np.uint8)
+
+
+def filter_mask(status, data1, channels=0xFFFF, commands=None, low=0, high=127):
+    """Boolean mask of the events MessageBatch.filter keeps, apply it with array[mask]"""
+    keep = (channels >> (status & 0x0F).astype(np.int64)) & 1 == 1
+    if commands is not None:
+        keep &= np.isin(status >> 4, list(commands))
+    note = data1 & 0x7F
+    keep &= ~is_note(status) | ((low <= note) & (note <= high))
+    return keep | ~is_channel_message(status)
+
+
+def benchmark_chain(seed=0):
+    """The transforms both benchmarks run: a random 300 rule TranscodeMap, a channel rotation and a velocity curve"""
+    import random
+
+    rng = random.Random(seed)
+    conv = TranscodeMap([[rng.randrange(16), rng.randrange(128), rng.randrange(16), rng.randrange(128)]
+                         for _ in range(300)])
+    channel_map = [(c + 1) % 16 for c in range(16)]
+    curve = [min(127, int(v ** 0.8 * 127 ** 0.2)) for v in range(128)]
+    return conv, channel_map, curve
+
+
+def run_chain_batch(batch: MessageBatch, conv, channel_map, curve) -> MessageBatch:
+    """The benchmark chain on a MessageBatch, per message"""
+    batch.transcode(conv)
+    batch.transpose(12)
+    batch.velocity_curve(curve)
+    batch.set_channel(channel_map)
+    return batch.filter(channels=0x00FF, low=36, high=96)
+
+
+def run_chain(status, data1, data2, timestamp, conv, channel_map, curve):
+    """The benchmark chain on arrays, vectorized"""
+    status, data1 = transcode(status, data1, conv)
+    data1 = transpose(status, data1, 12)
+    data2 = velocity_curve(status, data2, curve)
+    status = remap_channels(status, channel_map)
+    keep = filter_mask(status, data1, channels=0x00FF, low=36, high=96)
+    return status[keep], data1[keep], data2[keep], timestamp[keep]
+
+
+def benchmark(num_events=1_000_000, seed=0):
+    import time
+
+    rng = np.random.default_rng(seed)
+    status = rng.integers(0x80, 0xF0, num_events, dtype=np.uint8)
+    data1 = rng.integers(0, 128, num_events, dtype=np.uint8)
+    data2 = rng.integers(0, 128, num_events, dtype=np.uint8)
+    timestamp = np.arange(num_events, dtype=np.uint32)
+    chain = benchmark_chain(seed)
+
+    batch = to_batch(status, data1, data2, timestamp)
+    start = time.perf_counter()
+    batch = run_chain_batch(batch, *chain)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    status, data1, data2, timestamp = run_chain(status, data1, data2, timestamp, *chain)
+    vector_time = time.perf_counter() - start
+
+    expected = to_batch(status, data1, data2, timestamp)
+    identical = batch.messages == expected.messages and batch.timestamps == expected.timestamps
+    print(f"events: {num_events} kept: {len(batch)} identical: {identical}")
+    print(f"per-message: {loop_time:.3f}s ({num_events / loop_time:,.0f} events/s)")
+    print(f"vectorized:  {vector_time:.3f}s ({num_events / vector_time:,.0f} events/s)")
+    print(f"speedup: {loop_time / vector_time:.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,229 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI device registry
+
+Enumerates the PortMidi devices once and indexes them by name, interface and direction. Ports opened through the
+registry are Connections: they keep working when the device is unplugged (reads return nothing, writes are dropped)
+and are reopened by name when it is plugged back in. PortMidi only sees new devices after midi.quit()/midi.init(),
+which closes every open port, so refresh() reopens all connections. Ports opened with midi.Input/midi.Output
+directly do not survive a refresh.
+
+watch() does such a full rescan right after a connection was lost and, while a connection waits for its device, every
+interval seconds when no port is open or every rescan_interval seconds when others are open, as the rescan briefly
+cycles their ports. A replugged device comes back within rescan_interval seconds without any action.
+"""
+import threading
+
+from transcoder.utils.midi import get_midi, midi
+
+INPUT = "input"
+OUTPUT = "output"
+
+
+class Connection:
+    """A port opened by device name, see DeviceRegistry.open_input() and open_output()."""
+    def __init__(self, registry, name, direction, **kwargs):
+        self.registry = registry
+        self.name = name
+        self.direction = direction
+        self.kwargs = kwargs
+        self.port = None
+        self.info = None
+        self.connects = 0
+        self.losses = 0
+        self.dropped = 0  # events written while disconnected
+
+    @property
+    def connected(self):
+        return self.port is not None
+
+    def attach(self):
+        info = self.registry.find(self.name, self.direction)
+        if info is None:
+            return False
+        port_type = midi.Input if self.direction == INPUT else midi.Output
+        self.port = port_type(info["idx"], **self.kwargs)
+        self.info = info
+        self.connects += 1
+        return True
+
+    def detach(self):
+        port, self.port = self.port, None
+        if port is not None:
+            try:
+                port.close()
+            except midi.MidiException:
+                pass
+
+    def lost(self, error):
+        print(f"MIDI {self.direction} {self.name} lost: {error}")
+        self.losses += 1
+        self.detach()
+        self.registry.rescan_needed.set()
+
+    def poll(self):
+        with self.registry.lock:
+            if self.port is None:
+                return False
+            try:
+                return self.port.poll()
+            except midi.MidiException as e:
+                self.lost(e)
+                return False
+
+    def read(self, num_events):
+        with self.registry.lock:
+            if self.port is None:
+                return []
+            try:
+                return self.port.read(num_events)
+            except midi.MidiException as e:
+                self.lost(e)
+                return []
+
+    def write(self, events):
+        with self.registry.lock:
+            if self.port is None:
+                self.dropped += len(events)
+                return
+            try:
+                self.port.write(events)
+            except midi.MidiException as e:
+                self.dropped += len(events)
+                self.lost(e)
+
+    def write_short(self, status, data1=0, data2=0):
+        self.write([[[status, data1, data2, 0], 0]])
+
+    def close(self):
+        with self.registry.lock:
+            self.detach()
+            if self in self.registry.connections:
+                self.registry.connections.remove(self)
+
+
+class DeviceRegistry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.rescan_needed = threading.Event()
+        self.initialized = False
+        self.devices = []
+        self.by_name = {}  # (name, direction) -> device info, the first device when names are not unique
+        self.by_iface = {}  # interface -> device infos
+        self.connections = []
+        self.scans = 0
+
+    def scan(self):
+        devices = get_midi()
+        by_name, by_iface = {}, {}
+        for info in devices:
+            for direction in (INPUT, OUTPUT):
+                if info[direction] == 1:
+                    by_name.setdefault((info["name"], direction), info)
+            by_iface.setdefault(info["iface"], []).append(info)
+        self.devices, self.by_name, self.by_iface = devices, by_name, by_iface
+        self.scans += 1
+
+    def ensure(self):
+        """Initialize PortMidi and enumerate the devices, once."""
+        with self.lock:
+            if not self.initialized:
+                midi.init()
+                self.initialized = True
+                self.scan()
+
+    def refresh(self):
+        """Rescan the devices and reopen the connections, also the ones whose device reappeared."""
+        with self.lock:
+            was_connected = {id(connection) for connection in self.connections if connection.connected}
+            for connection in self.connections:
+                connection.detach()
+            if self.initialized:
+                midi.quit()
+            midi.init()
+            self.initialized = True
+            self.scan()
+            self.rescan_needed.clear()
+            for connection in self.connections:
+                if connection.attach() and connection.connects > 1 and id(connection) not in was_connected:
+                    print(f"MIDI {connection.direction} {connection.name} reconnected")
+
+    @property
+    def inputs(self):
+        self.ensure()
+        return [info for info in self.devices if info[INPUT] == 1]
+
+    @property
+    def outputs(self):
+        self.ensure()
+        return [info for info in self.devices if info[OUTPUT] == 1]
+
+    def find(self, name, direction):
+        """The device info for a name and direction, None when not present."""
+        self.ensure()
+        return self.by_name.get((name, direction))
+
+    def open(self, name, direction, wait=False, **kwargs):
+        """
+        Open a Connection to the named device. Raises a RuntimeError when the device is not present, unless wait is
+        set: then the connection is opened as soon as a rescan finds the device.
+        """
+        with self.lock:
+            connection = Connection(self, name, direction, **kwargs)
+            if not connection.attach():
+                if not wait:
+                    raise RuntimeError(f"Device named {name} not found")
+                print(f"Waiting for MIDI {direction} {name}")
+            self.connections.append(connection)
+            return connection
+
+    def open_input(self, name, wait=False, **kwargs):
+        return self.open(name, INPUT, wait, **kwargs)
+
+    def open_output(self, name, wait=False, **kwargs):
+        return self.open(name, OUTPUT, wait, **kwargs)
+
+    def watch(self, interval=1.0, stop=None, rescan_interval=5.0):
+        """
+        Rescan from a daemon thread right after a connection was lost, and while a connection is waiting for its
+        device every interval seconds when no port is open, every rescan_interval seconds when there are.
+        """
+        stop = stop or threading.Event()
+
+        def run():
+            waited = 0.0
+            while not stop.is_set():
+                lost = self.rescan_needed.wait(interval)
+                if stop.is_set():
+                    break
+                if lost:
+                    self.refresh()
+                    waited = 0.0
+                elif any(not c.connected for c in self.connections):
+                    waited += interval
+                    if waited >= rescan_interval or not any(c.connected for c in self.connections):
+                        self.refresh()
+                        waited = 0.0
+                else:
+                    waited = 0.0
+
+        threading.Thread(target=run, name="DeviceWatch", daemon=True).start()
+        return stop
+
+
+devices = DeviceRegistry()
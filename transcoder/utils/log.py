@@ -0,0 +1,131 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI message log
+
+Keeps console printing off the MIDI thread. The hot loop only stores references to the raw PortMidi messages
+((status, byte1, byte2, 0), timestamp) in a preallocated ring buffer; a background thread formats and prints them.
+"""
+import threading
+import time
+
+from transcoder.utils.midi import friendly_message, NOTE_ON, NOTE_OFF
+
+VERBOSITY_OFF = 0
+VERBOSITY_NOTES = 1
+VERBOSITY_ALL = 2
+
+
+class MessageLog:
+    """
+    Single producer, single consumer ring buffer of MIDI messages.
+
+    push() never blocks: when the buffer is full the message is counted in `dropped` and discarded. The printing
+    thread prints at most max_lines_per_sec lines, excess lines are counted in `suppressed`. With verbosity
+    VERBOSITY_OFF `enabled` is False, callers check it before pushing so logging costs a single attribute lookup.
+    """
+    def __init__(self, size=1024, verbosity=VERBOSITY_NOTES, max_lines_per_sec=200, interval=0.05):
+        self.size = 1 << (size - 1).bit_length()  # power of two, so the slot is head & mask
+        self.mask = self.size - 1
+        self.prefixes = [None] * self.size
+        self.messages = [None] * self.size
+        self.out_messages = [None] * self.size
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.suppressed = 0
+        self.max_lines_per_sec = max_lines_per_sec
+        self.interval = interval
+        self.verbosity = verbosity
+        self.enabled = verbosity > VERBOSITY_OFF
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def set_verbosity(self, verbosity):
+        self.verbosity = verbosity
+        self.enabled = verbosity > VERBOSITY_OFF
+
+    def push(self, message, out_message=None, prefix=""):
+        if not self.enabled:
+            return
+        if self.verbosity < VERBOSITY_ALL and (message[0][0] >> 4) not in (NOTE_ON, NOTE_OFF):
+            return
+        head = self.head
+        if head - self.tail > self.mask:
+            self.dropped += 1
+            return
+        slot = head & self.mask
+        self.prefixes[slot] = prefix
+        self.messages[slot] = message
+        self.out_messages[slot] = out_message
+        self.head = head + 1
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name="MessageLog", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def run(self):
+        budget = self.max_lines_per_sec
+        last = time.perf_counter()
+        lost = 0
+        while not self.stop_event.wait(self.interval):
+            now = time.perf_counter()
+            budget = min(budget + (now - last) * self.max_lines_per_sec, self.max_lines_per_sec)
+            last = now
+            budget -= self.flush(int(budget))
+            if self.dropped + self.suppressed != lost:
+                lost = self.dropped + self.suppressed
+                print(f"Log: {self.summary()}")
+
+    def flush(self, max_lines=None):
+        """Format and print the pending messages, returns the number of printed lines."""
+        head = self.head
+        lines = []
+        for i in range(self.tail, head):
+            slot = i & self.mask
+            if max_lines is None or len(lines) < max_lines:
+                out_message = self.out_messages[slot]
+                if out_message is None:
+                    lines.append(f"{self.prefixes[slot]}{friendly_message(self.messages[slot])}")
+                else:
+                    lines.append(f"{self.prefixes[slot]}{friendly_message(self.messages[slot])} -> "
+                                 f"{friendly_message(out_message)}")
+            else:
+                self.suppressed += 1
+            self.messages[slot] = self.out_messages[slot] = None
+        self.tail = head
+        if lines:
+            print("\n".join(lines))
+        return len(lines)
+
+    def summary(self):
+        return f"pending: {self.head - self.tail} dropped: {self.dropped} suppressed: {self.suppressed}"
+
+
+# Shared log for the transcoder loops and the GUI forwarding thread
+message_log = MessageLog()
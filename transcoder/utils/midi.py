@@ -1,12 +1,59 @@
 from typing import List, Any
 
-import pygame.midi as midi
+from array import array
+import heapq
+import importlib
 import time
 
+
+class LazyModule:
+    """
+    Imports the module on first attribute access. pygame.midi pulls in most of pygame (and NumPy when installed),
+    deferring it lets the entry points start on other work first. import_ns is the time the import took.
+    """
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+        self.__dict__["import_ns"] = 0
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            start = time.perf_counter_ns()
+            module = importlib.import_module(self._name)
+            self.__dict__["import_ns"] = time.perf_counter_ns() - start
+            self.__dict__["_module"] = module
+        return getattr(module, attr)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+
+midi = LazyModule("pygame.midi")
+
+# Clock of the event timestamps in ms, PortMidi's unless a backend sets its own (see utils/backends.py)
+_clock = None
+
+
+def time_ms():
+    return _clock() if _clock is not None else midi.time()
+
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
 NOTE_ON = 0x9
 NOTE_OFF = 0x8
 NOTE_AT = 0xD
 
+# Event pump defaults: events drained per read() and the worst case latency added while idle
+BATCH_SIZE = 64
+MAX_LATENCY_US = 1000
+# pygame.midi refuses to write more than 1024 events at once
+MAX_WRITE = 1024
+
 
 def number_to_note(number):
     notes = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
@@ -25,7 +72,7 @@ def full_note_to_number(full_note: str):
     notes = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
     if full_note[1] == '#':
         note = full_note[:2]
-        oct = full_note[2:]
+        oct = int(full_note[2:])
     else:
         note = full_note[0]
         oct = int(full_note[1:])
@@ -84,6 +131,130 @@ def encode_message(timestamp, channel, cmd, byte1, byte2):
     return message
 
 
+class TranscodeMap:
+    """
+    Compiled form of a list of [channel_from, note_from, channel_to, note_to] rules.
+
+    The rules are flattened into a 16x128 table indexed by (channel << 7) | note, so a lookup costs the same
+    regardless of the number of rules. Unmapped entries map onto themselves. When several rules share the same
+    (channel_from, note_from) either the first or the last one wins, depending on `match` ("first" or "last").
+    """
+    def __init__(self, conv, match="last"):
+        if match not in ["first", "last"]:
+            raise ValueError(f"Unknown match mode {match}, use 'first' or 'last'")
+        self.match = match
+        self.table = list(range(16 * 128))
+        rules = conv if match == "last" else reversed(conv)
+        for channel_from, note_from, channel_to, note_to in rules:
+            for value in [channel_from, channel_to]:
+                if not 0 <= value < 16:
+                    raise ValueError(f"Channel {value} out of range [0..15]")
+            for value in [note_from, note_to]:
+                if not 0 <= value < 128:
+                    raise ValueError(f"Note {value} out of range [0..127]")
+            self.table[(channel_from << 7) | note_from] = (channel_to << 7) | note_to
+
+    def __getitem__(self, key):
+        channel, note = key
+        dest = self.table[(channel << 7) | note]
+        return dest >> 7, dest & 0x7F
+
+
+def pack_message(status, byte1, byte2):
+    """Pack a message into one int, same layout as PortMidi's PmMessage."""
+    return status | (byte1 << 8) | (byte2 << 16)
+
+
+def unpack_message(packed):
+    return packed & 0xFF, (packed >> 8) & 0xFF, (packed >> 16) & 0xFF
+
+
+class MessageBatch:
+    """
+    Struct-of-arrays batch of messages: packed messages (see pack_message) in an array('I') and a parallel
+    array('I') of timestamps. The transforms work on the whole batch in place, conversion from and to the PortMidi
+    list format only happens at the read and write boundary.
+    """
+    __slots__ = ("messages", "timestamps")
+
+    def __init__(self, messages=None, timestamps=None):
+        self.messages = array("I") if messages is None else messages
+        self.timestamps = array("I") if timestamps is None else timestamps
+
+    @classmethod
+    def from_events(cls, events):
+        return cls(array("I", [status | (byte1 << 8) | (byte2 << 16) for (status, byte1, byte2, _), _ in events]),
+                   array("I", [timestamp for _, timestamp in events]))
+
+    def to_events(self):
+        return [[[m & 0xFF, (m >> 8) & 0xFF, (m >> 16) & 0xFF, 0], timestamp]
+                for m, timestamp in zip(self.messages, self.timestamps)]
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, packed, timestamp):
+        self.messages.append(packed)
+        self.timestamps.append(timestamp)
+
+    def transcode(self, conv):
+        """
+        Remap the channel and note of NOTE_ON and NOTE_OFF messages using a TranscodeMap. Returns the number of note
+        messages no rule matched.
+        """
+        table = conv.table
+        messages = self.messages
+        unmatched = 0
+        for i, m in enumerate(messages):
+            if m & 0xE0 == 0x80:
+                key = (m & 0x0F) << 7 | (m >> 8) & 0x7F
+                dest = table[key]
+                if dest != key:
+                    messages[i] = (m & 0xFF00F0) | (dest & 0x7F) << 8 | dest >> 7
+                else:
+                    unmatched += 1
+        return unmatched
+
+    def transpose(self, semitones, channels=0xFFFF):
+        """Transpose NOTE_ON, NOTE_OFF and NOTE_AT messages on the channels in the bit mask, clamped to 0..127."""
+        messages = self.messages
+        for i, m in enumerate(messages):
+            if (m & 0xE0 == 0x80 or m & 0xF0 == 0xA0) and channels >> (m & 0x0F) & 1:
+                note = min(max(((m >> 8) & 0x7F) + semitones, 0), 127)
+                messages[i] = (m & 0xFF00FF) | note << 8
+
+    def velocity_curve(self, curve):
+        """Map the velocity of NOTE_ON messages with a velocity above 0 through a 128 entry curve."""
+        messages = self.messages
+        for i, m in enumerate(messages):
+            if m & 0xF0 == 0x90 and m & 0x7F0000:
+                messages[i] = (m & 0x00FFFF) | curve[(m >> 16) & 0x7F] << 16
+
+    def set_channel(self, channel_map):
+        """Rewrite the channel of all channel messages, channel_map holds the new channel for each of the 16."""
+        messages = self.messages
+        for i, m in enumerate(messages):
+            if m & 0xF0 != 0xF0:
+                messages[i] = (m & 0xFFFFF0) | channel_map[m & 0x0F]
+
+    def filter(self, channels=0xFFFF, commands=None, low=0, high=127):
+        """
+        Return a new batch with the channel messages on the channels in the bit mask and with a command in commands
+        (all when None). Note messages are also limited to the key range low..high. System messages are kept.
+        """
+        result = MessageBatch()
+        for m, timestamp in zip(self.messages, self.timestamps):
+            if m & 0xF0 != 0xF0:
+                if not channels >> (m & 0x0F) & 1:
+                    continue
+                if commands is not None and (m & 0xFF) >> 4 not in commands:
+                    continue
+                if m & 0xE0 == 0x80 and not low <= (m >> 8) & 0x7F <= high:
+                    continue
+            result.append(m, timestamp)
+        return result
+
+
 def friendly_message(message):
     timestamp, channel, cmd, byte1, byte2 = decode_message(message)
     if cmd in [NOTE_ON, NOTE_OFF]:
@@ -94,12 +265,87 @@ def friendly_message(message):
     return msg
 
 
-def monitor_inputs(midi_input, only_notes=False):
-    while True:
+class AdaptiveSleep:
+    """
+    Backs off exponentially while idle, from min_sleep_us up to max_latency_us, and snaps back on activity.
+    The worst case latency added to the first event after an idle period is max_latency_us.
+    """
+    def __init__(self, max_latency_us=MAX_LATENCY_US, min_sleep_us=50):
+        self.max_sleep = max_latency_us / 1e6
+        self.min_sleep = min(min_sleep_us, max_latency_us) / 1e6
+        self.current = self.min_sleep
+
+    def wait(self):
+        time.sleep(self.current)
+        self.current = min(self.current * 2, self.max_sleep)
+
+    def reset(self):
+        self.current = self.min_sleep
+
+
+def pump_events(midi_input, batch_size=BATCH_SIZE, max_latency_us=MAX_LATENCY_US, stop=None):
+    """Yield lists of up to batch_size pending events, sleeping adaptively while the input is idle."""
+    idle = AdaptiveSleep(max_latency_us)
+    while stop is None or not stop.is_set():
         if midi_input.poll():
-            message = midi_input.read(1)[0]
+            batch = midi_input.read(batch_size)
+            if batch:
+                idle.reset()
+                yield batch
+                continue
+        idle.wait()
+
+
+def write_batch(midi_output, messages):
+    for i in range(0, len(messages), MAX_WRITE):
+        midi_output.write(messages[i:i + MAX_WRITE] if len(messages) > MAX_WRITE else messages)
+
+
+class InputMux:
+    """
+    Services any number of input ports fairly and merges their events in timestamp order.
+
+    Every read() drains up to batch_size events from each port, so a busy port cannot starve the others. received
+    counts the events read per port and backlog counts the reads after which a port still had events pending.
+    """
+    def __init__(self, inputs, batch_size=BATCH_SIZE, max_latency_us=MAX_LATENCY_US):
+        self.inputs = list(inputs)
+        self.batch_size = batch_size
+        self.max_latency_us = max_latency_us
+        self.received = [0] * len(self.inputs)
+        self.backlog = [0] * len(self.inputs)
+
+    def read(self):
+        """Return a list of (port index, message) tuples in timestamp order, empty when all ports are idle."""
+        batches = []
+        for port, midi_input in enumerate(self.inputs):
+            if midi_input.poll():
+                batch = midi_input.read(self.batch_size)
+                if batch:
+                    self.received[port] += len(batch)
+                    if len(batch) == self.batch_size and midi_input.poll():
+                        self.backlog[port] += 1
+                    batches.append([(port, message) for message in batch])
+        if len(batches) == 1:
+            return batches[0]
+        return list(heapq.merge(*batches, key=lambda event: event[1][1]))
+
+    def pump(self, stop=None):
+        """Yield merged batches, sleeping adaptively while all ports are idle."""
+        idle = AdaptiveSleep(self.max_latency_us)
+        while stop is None or not stop.is_set():
+            events = self.read()
+            if events:
+                idle.reset()
+                yield events
+            else:
+                idle.wait()
+
+
+def monitor_inputs(midi_input, only_notes=False, max_latency_us=MAX_LATENCY_US):
+    for batch in pump_events(midi_input, max_latency_us=max_latency_us):
+        for message in batch:
             timestamp, channel, cmd, note, velo = decode_message(message)
             if cmd in [NOTE_ON, NOTE_OFF] or not only_notes:
                 print(friendly_message(message))
-        time.sleep(0)
 
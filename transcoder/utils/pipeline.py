@@ -0,0 +1,297 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI transform pipeline
+
+A pipeline is a list of stages declared once, for example Pipeline([Filter(channels=1 << 9), Remap(conv),
+RoundRobin(9, [0, 1, 2, 3])]). Stateless stages only look at the status byte and the first data byte, consecutive
+stateless stages are fused into one 128x128 lookup table when the pipeline is built, so chaining them costs a single
+lookup per message. Stateful stages process the whole MessageBatch.
+"""
+import heapq
+import threading
+
+from transcoder.utils.midi import MessageBatch, TranscodeMap, InputMux, write_batch, MAX_LATENCY_US, \
+    NOTE_ON, NOTE_OFF
+from transcoder.utils.voices import VoiceAllocator, ROUND_ROBIN, SUSTAIN_CC
+
+CC = 0xB
+
+
+class Stage:
+    stateless = False
+
+    def process(self, batch: MessageBatch) -> MessageBatch:
+        raise NotImplementedError
+
+
+class StatelessStage(Stage):
+    """Stage that maps (status, data1) onto a new (status, data1), or None to drop the message."""
+    stateless = True
+
+    def map(self, status, data1):
+        raise NotImplementedError
+
+    def process(self, batch):
+        return FusedStage([self]).process(batch)
+
+
+class Filter(StatelessStage):
+    """Keep channel messages on the channels in the bit mask, with a command in commands and notes in low..high."""
+    def __init__(self, channels=0xFFFF, commands=None, low=0, high=127):
+        self.channels = channels
+        self.commands = commands
+        self.low = low
+        self.high = high
+
+    def map(self, status, data1):
+        if status < 0xF0:
+            if not self.channels >> (status & 0x0F) & 1:
+                return None
+            if self.commands is not None and status >> 4 not in self.commands:
+                return None
+            if status >> 4 in (NOTE_ON, NOTE_OFF) and not self.low <= data1 <= self.high:
+                return None
+        return status, data1
+
+
+class Thru(Filter):
+    """Pass the messages on the channels in the bit mask through untouched, used for the thru ports."""
+    def __init__(self, channels=0xFFFF):
+        super().__init__(channels=channels)
+
+
+class Remap(StatelessStage):
+    """Transcode notes with [channel_from, note_from, channel_to, note_to] rules, see TranscodeMap."""
+    def __init__(self, conv, match="last"):
+        self.conv = conv if isinstance(conv, TranscodeMap) else TranscodeMap(conv, match)
+
+    def map(self, status, data1):
+        if status >> 4 in (NOTE_ON, NOTE_OFF):
+            channel, data1 = self.conv[status & 0x0F, data1]
+            status = (status & 0xF0) | channel
+        return status, data1
+
+
+class Transpose(StatelessStage):
+    """Transpose notes and polyphonic aftertouch on the channels in the bit mask, clamped to 0..127."""
+    def __init__(self, semitones, channels=0xFFFF):
+        self.semitones = semitones
+        self.channels = channels
+
+    def map(self, status, data1):
+        if status >> 4 in (NOTE_ON, NOTE_OFF, 0xA) and self.channels >> (status & 0x0F) & 1:
+            data1 = min(max(data1 + self.semitones, 0), 127)
+        return status, data1
+
+
+class Channel(StatelessStage):
+    """Move every channel message to channel_map[channel]."""
+    def __init__(self, channel_map):
+        self.channel_map = list(channel_map)
+
+    def map(self, status, data1):
+        if status < 0xF0:
+            status = (status & 0xF0) | self.channel_map[status & 0x0F]
+        return status, data1
+
+
+class FusedStage(Stage):
+    """Consecutive stateless stages compiled into one table indexed by (status & 0x7F) << 7 | data1."""
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.table = []
+        for status in range(0x80, 0x100):
+            for data1 in range(128):
+                result = (status, data1)
+                for stage in self.stages:
+                    result = stage.map(*result)
+                    if result is None:
+                        break
+                self.table.append(-1 if result is None else result[0] | result[1] << 8)
+
+    def process(self, batch):
+        table = self.table
+        result = MessageBatch()
+        append = result.append
+        for m, timestamp in zip(batch.messages, batch.timestamps):
+            packed = table[(m & 0x7F) << 7 | (m >> 8) & 0x7F]
+            if packed >= 0:
+                append(packed | (m & 0xFF0000), timestamp)
+        return result
+
+
+class VelocityCurve(Stage):
+    """Map NOTE_ON velocities through a 128 entry curve."""
+    def __init__(self, curve):
+        self.curve = list(curve)
+
+    def process(self, batch):
+        batch.velocity_curve(self.curve)
+        return batch
+
+
+class VelocityCC(Stage):
+    """Prepend a control change carrying the velocity to every NOTE_ON, for synths like the KORG Volca FM."""
+    def __init__(self, cc=41, channels=0xFFFF):
+        self.cc = cc
+        self.channels = channels
+
+    def process(self, batch):
+        result = MessageBatch()
+        append = result.append
+        for m, timestamp in zip(batch.messages, batch.timestamps):
+            if m & 0xF0 == 0x90 and m & 0x7F0000 and self.channels >> (m & 0x0F) & 1:
+                append((CC << 4) | (m & 0x0F) | self.cc << 8 | (m & 0x7F0000), timestamp)
+            append(m, timestamp)
+        return result
+
+
+class RoundRobin(Stage):
+    """
+    Spread the notes of in_channel over out_channels with a VoiceAllocator. A NOTE_ON with velocity 0 is a note off,
+    the sustain pedal on in_channel is handled by the allocator. Other messages pass when echo_other is set.
+    """
+    def __init__(self, in_channel, out_channels, echo_other=True, policy=ROUND_ROBIN, polyphony=1):
+        self.in_channel = in_channel
+        self.echo_other = echo_other
+        self.voices = VoiceAllocator(out_channels, policy, polyphony)
+
+    def process(self, batch):
+        result = MessageBatch()
+        append = result.append
+        voices = self.voices
+        for m, timestamp in zip(batch.messages, batch.timestamps):
+            if m & 0x0F != self.in_channel:
+                if self.echo_other:
+                    append(m, timestamp)
+            elif m & 0xE0 == 0x80:
+                note = (m >> 8) & 0x7F
+                if m & 0xF0 == 0x90 and m & 0x7F0000:
+                    channel, stolen_channel, stolen_note = voices.note_on(note)
+                    if stolen_note >= 0:
+                        append((NOTE_OFF << 4) | stolen_channel | stolen_note << 8, timestamp)
+                    append((m & 0xFFFFF0) | channel, timestamp)
+                else:
+                    channel = voices.note_off(note)
+                    if channel >= 0:
+                        append((m & 0xFFFFF0) | channel, timestamp)
+            elif m & 0xFFF0 == (SUSTAIN_CC << 8) | (CC << 4):
+                for channel, note in voices.sustain_pedal(m >> 16 >= 64):
+                    append((NOTE_OFF << 4) | channel | note << 8, timestamp)
+            elif self.echo_other:
+                append(m, timestamp)
+        return result
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = []
+        stateless = []
+        for stage in list(stages) + [None]:
+            if stage is not None and stage.stateless:
+                stateless.append(stage)
+                continue
+            if stateless:
+                self.stages.append(FusedStage(stateless))
+                stateless = []
+            if stage is not None:
+                self.stages.append(stage)
+
+    def process(self, batch: MessageBatch) -> MessageBatch:
+        for stage in self.stages:
+            batch = stage.process(batch)
+        return batch
+
+    def process_events(self, events):
+        """Run PortMidi events ([[status, data1, data2, 0], timestamp]) through the pipeline."""
+        return self.process(MessageBatch.from_events(events)).to_events()
+
+
+def run_pipeline(pipelines, inputs, midi_output, stop=None, max_latency_us=MAX_LATENCY_US):
+    """
+    Run one pipeline per input port and write the results, merged in timestamp order, to midi_output.
+    For example run_pipeline([Pipeline([Remap(conv)]), Pipeline([Thru()])], [keyboard, thru], output).
+    """
+    mux = InputMux(inputs, max_latency_us=max_latency_us)
+    for events in mux.pump(stop):
+        per_port = [[] for _ in inputs]
+        for port, message in events:
+            per_port[port].append(message)
+        outputs = [pipeline.process_events(port_events)
+                   for pipeline, port_events in zip(pipelines, per_port) if port_events]
+        if len(outputs) == 1:
+            write_batch(midi_output, outputs[0])
+        elif outputs:
+            write_batch(midi_output, list(heapq.merge(*outputs, key=lambda event: event[1])))
+
+
+def run_callback(pipeline, midi_input, midi_output, stop=None):
+    """
+    Run the pipeline from the input's callback, for inputs of callback driven backends (see utils/backends.py), so
+    no thread polls. Blocks until stop is set.
+    """
+    def on_events(events):
+        result = pipeline.process_events(events)
+        if result:
+            write_batch(midi_output, result)
+
+    midi_input.set_callback(on_events)
+    stop = stop or threading.Event()
+    try:
+        while not stop.wait(0.5):
+            pass
+    finally:
+        midi_input.set_callback(None)
+
+
+def message_length(status):
+    if status in (0xF1, 0xF3) or status >> 4 in (0xC, 0xD):
+        return 2
+    if status >= 0xF4:
+        return 1
+    return 3
+
+
+def jack_process_callback(pipeline, inport, outport):
+    """
+    Return a JACK process callback running the pipeline on inport and writing to outport, the frame offset is used
+    as timestamp. Register it with client.set_process_callback().
+    """
+    def process(frames):
+        outport.clear_buffer()
+        batch = MessageBatch()
+        sysex = []
+        for offset, data in inport.incoming_midi_events():
+            if len(data) > 3:  # system exclusive bypasses the pipeline
+                sysex.append((offset, bytes(data)))
+                continue
+            packed = 0
+            for i, byte in enumerate(bytes(data)):
+                packed |= byte << (8 * i)
+            batch.append(packed, offset)
+        batch = pipeline.process(batch)
+        # JACK requires events in frame order
+        pending = 0
+        for m, offset in zip(batch.messages, batch.timestamps):
+            while pending < len(sysex) and sysex[pending][0] <= offset:
+                outport.write_midi_event(*sysex[pending])
+                pending += 1
+            outport.write_midi_event(offset, m.to_bytes(4, "little")[:message_length(m & 0xFF)])
+        for event in sysex[pending:]:
+            outport.write_midi_event(*event)
+    return process
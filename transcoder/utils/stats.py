@@ -0,0 +1,167 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI hot path instrumentation
+
+Every transcoder path records into a named Stats object (see get_stats): the processing time per message from read
+to write, the number of events per read (queue depth), loop iterations and dropped or unmatched events. Recording
+only increments preallocated counters. Use summary() for people and dump() for scripts.
+"""
+import json
+import threading
+import time
+from array import array
+
+
+class Histogram:
+    """
+    HDR-style log-linear histogram for non-negative integers.
+
+    Values below 2 ** (sub_bucket_bits + 1) are counted exactly, above that every power of two is split into
+    2 ** sub_bucket_bits linear buckets, so the relative error of a percentile is at most 2 ** -sub_bucket_bits.
+    The buckets are preallocated, record() does not grow anything.
+    """
+    def __init__(self, sub_bucket_bits=5, max_bits=40):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.max_value = (1 << max_bits) - 1
+        self.counts = array("Q", [0]) * (self.index(self.max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        shift = value.bit_length() - self.sub_bucket_bits - 1
+        if shift <= 0:
+            return value
+        return (shift << self.sub_bucket_bits) + (value >> shift)
+
+    def value_at(self, index):
+        """Lowest value counted in bucket index"""
+        if index < 2 << self.sub_bucket_bits:
+            return index
+        shift = (index >> self.sub_bucket_bits) - 1
+        return (index - (shift << self.sub_bucket_bits)) << shift
+
+    def record(self, value, count=1):
+        if value > self.max_value:
+            value = self.max_value
+        self.counts[self.index(value)] += count
+        self.count += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = self.count * p / 100
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= target:
+                return min(self.value_at(i + 1) - 1, self.max)  # highest value in the bucket
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = self.total = self.max = 0
+
+    def dump(self):
+        return {"count": self.count, "mean": self.mean(), "max": self.max,
+                "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99),
+                "p999": self.percentile(99.9),
+                "buckets": {self.value_at(i): c for i, c in enumerate(self.counts) if c}}
+
+
+class Stats:
+    def __init__(self, name):
+        self.name = name
+        self.latency_ns = Histogram()  # read to write, per message
+        self.age_ms = Histogram()  # PortMidi timestamp to read, oldest message per read
+        self.batch_size = Histogram()  # events per read, the queue depth seen by the loop
+        self.iterations = 0
+        self.messages = 0
+        self.dropped = 0
+        self.unmatched = 0
+        self.extra = {}  # additional counters, e.g. per port backlogs
+        self.histograms = {}  # additional histograms, see histogram()
+
+    def histogram(self, name) -> Histogram:
+        """An additional named histogram, created on first use."""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def record_batch(self, start_ns, num_messages):
+        """Call after writing a batch that was read at start_ns (time.perf_counter_ns())."""
+        self.latency_ns.record(time.perf_counter_ns() - start_ns, num_messages)
+        self.batch_size.record(num_messages)
+        self.iterations += 1
+        self.messages += num_messages
+
+    def summary(self):
+        lat = self.latency_ns
+        return (f"{self.name}: messages: {self.messages} iterations: {self.iterations} "
+                f"latency us p50: {lat.percentile(50) / 1000:.1f} p99: {lat.percentile(99) / 1000:.1f} "
+                f"max: {lat.max / 1000:.1f} age ms p99: {self.age_ms.percentile(99)} "
+                f"batch p99: {self.batch_size.percentile(99)} dropped: {self.dropped} unmatched: {self.unmatched}"
+                + "".join(f" {key}: {value}" for key, value in self.extra.items())
+                + "".join(f" {key} p50: {h.percentile(50)} p99: {h.percentile(99)}"
+                          for key, h in self.histograms.items()))
+
+    def dump(self):
+        return {"name": self.name, "messages": self.messages, "iterations": self.iterations,
+                "dropped": self.dropped, "unmatched": self.unmatched, "latency_ns": self.latency_ns.dump(),
+                "age_ms": self.age_ms.dump(), "batch_size": self.batch_size.dump(), **self.extra,
+                **{key: h.dump() for key, h in self.histograms.items()}}
+
+
+registry = {}
+
+
+def get_stats(name) -> Stats:
+    if name not in registry:
+        registry[name] = Stats(name)
+    return registry[name]
+
+
+def dump_stats(path=None):
+    """Return all stats as a JSON string, and write it to path when given."""
+    text = json.dumps({name: stats.dump() for name, stats in registry.items()}, indent=2)
+    if path is not None:
+        with open(path, "w") as f:
+            f.write(text)
+    return text
+
+
+def report_periodically(interval=10.0, path=None, stop=None):
+    """Print a summary of all stats every interval seconds from a daemon thread, and dump them to path."""
+    stop = stop or threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            for stats in list(registry.values()):
+                print(stats.summary())
+            if path is not None:
+                dump_stats(path)
+
+    threading.Thread(target=run, name="Stats", daemon=True).start()
+    return stop
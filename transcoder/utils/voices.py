@@ -0,0 +1,126 @@
+"""
+This file is part of the MIDITools distribution (https://github.com/kdijkstra13/MIDITools).
+Copyright (c) 2023 Klaas Dijkstra
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+drClass' MIDI voice allocator
+
+Distributes the notes of one input channel over a number of output channels (voices), for example to play a
+monophonic Elektron Model Cycles track per note and get a polyphonic synth.
+"""
+from typing import List
+
+ROUND_ROBIN = "round_robin"
+LRU = "lru"
+STEAL_OLDEST = "steal_oldest"
+
+SUSTAIN_CC = 64
+
+
+class VoiceAllocator:
+    """
+    Note-number-indexed voice allocator.
+
+    owner[note] holds the voice playing the note (-1 when silent), so note on and note off are O(1) in the number of
+    notes. Every voice plays up to polyphony notes. When all voices are full a note is stolen:
+    ROUND_ROBIN takes the oldest note of the next voice in turn, LRU the oldest note of the least recently started
+    voice and STEAL_OLDEST the oldest sounding note overall. Free voices are picked in turn (ROUND_ROBIN), least
+    recently used first (LRU) or least busy first (STEAL_OLDEST). While the sustain pedal is down note offs are held
+    back until the pedal is released.
+    """
+    def __init__(self, channels: List[int], policy=ROUND_ROBIN, polyphony=1):
+        if policy not in [ROUND_ROBIN, LRU, STEAL_OLDEST]:
+            raise ValueError(f"Unknown voice allocation policy {policy}")
+        if len(channels) == 0:
+            raise ValueError("At least one output channel is needed")
+        self.channels = list(channels)
+        self.policy = policy
+        self.polyphony = [polyphony] * len(self.channels) if isinstance(polyphony, int) else list(polyphony)
+        self.owner = [-1] * 128
+        self.started = [0] * 128
+        self.held = [False] * 128
+        self.notes = [[] for _ in self.channels]  # sounding notes per voice, oldest first
+        self.last_used = [0] * len(self.channels)
+        self.clock = 0
+        self.idx = 0
+        self.sustain = False
+        self.unmatched = 0  # note offs for notes that were not sounding
+        self.stolen = 0
+
+    def choose_voice(self):
+        num_voices = len(self.channels)
+        if self.policy == ROUND_ROBIN:
+            for k in range(num_voices):
+                voice = (self.idx + k) % num_voices
+                if len(self.notes[voice]) < self.polyphony[voice]:
+                    break
+            else:
+                voice = self.idx
+            self.idx = (voice + 1) % num_voices
+            return voice
+        free = [v for v in range(num_voices) if len(self.notes[v]) < self.polyphony[v]]
+        if self.policy == LRU:
+            return min(free or range(num_voices), key=lambda v: self.last_used[v])
+        if free:
+            return min(free, key=lambda v: len(self.notes[v]))
+        return min((v for v in range(num_voices) if self.notes[v]), key=lambda v: self.started[self.notes[v][0]])
+
+    def release(self, note):
+        voice = self.owner[note]
+        self.owner[note] = -1
+        self.held[note] = False
+        self.notes[voice].remove(note)
+        return voice
+
+    def note_on(self, note):
+        """
+        Allocate a voice for note. Returns (channel, stolen_channel, stolen_note), when stolen_note is not -1 a note
+        off for stolen_note has to be sent on stolen_channel first.
+        """
+        stolen_channel = stolen_note = -1
+        if self.owner[note] >= 0:  # retrigger of a sounding or sustained note
+            stolen_channel, stolen_note = self.channels[self.release(note)], note
+        voice = self.choose_voice()
+        if len(self.notes[voice]) >= self.polyphony[voice]:
+            stolen_channel, stolen_note = self.channels[voice], self.notes[voice][0]
+            self.release(stolen_note)
+            self.stolen += 1
+        self.clock += 1
+        self.owner[note] = voice
+        self.started[note] = self.clock
+        self.last_used[voice] = self.clock
+        self.notes[voice].append(note)
+        return self.channels[voice], stolen_channel, stolen_note
+
+    def note_off(self, note):
+        """Returns the channel to send the note off on, or -1 for unknown notes and notes held by the pedal."""
+        if self.owner[note] < 0:
+            self.unmatched += 1
+            return -1
+        if self.sustain:
+            self.held[note] = True
+            return -1
+        return self.channels[self.release(note)]
+
+    def sustain_pedal(self, down):
+        """Returns the (channel, note) pairs to send a note off for, non-empty when the pedal is released."""
+        self.sustain = down
+        if down:
+            return []
+        return [(self.channels[self.release(note)], note) for note in range(128) if self.held[note]]
+
+    def all_notes_off(self):
+        """Forget every sounding note, returns the (channel, note) pairs that need a note off."""
+        return [(self.channels[self.release(note)], note) for note in range(128) if self.owner[note] >= 0]
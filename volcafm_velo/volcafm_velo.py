@@ -17,26 +17,48 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 drClass' MIDI Trancoder
 Adds note velocity for the KORG Volca FM
+
+    volcafm_velo.py [FM] [--dedup] [-q]   one in/out pair adding CC 41 (with FM) on a JACK client named VolcaFM
+    volcafm_velo.py --config volcas.json  any number of in/out pairs, see load_config()
 """
 
 import jack
-import struct
+import json
 import time
 import sys
 import signal
+import threading
+from array import array
+
+# Instrumentation, durations[i] counts the process callbacks that took less than 2 ** i ns
+durations = [0] * 40
+stats = {"callbacks": 0, "events": 0, "unhandled": 0, "max_ns": 0, "xruns": 0, "log_dropped": 0,
+         "ccs_sent": 0, "ccs_skipped": 0, "bytes_saved": 0}
+
+
+def percentile(p):
+    target = sum(durations) * p / 100
+    seen = 0
+    for i, count in enumerate(durations):
+        seen += count
+        if count and seen >= target:
+            return 2 ** i
+    return 0
+
+
+def report(code=None, frame=None):
+    summary = dict(stats, p50_ns=percentile(50), p99_ns=percentile(99), durations=durations)
+    print(json.dumps(summary))
+
 
 def close(code, frame):
+    report()
     print("Terminating.")
     sys.exit(0)
 
-use_fm = False
-
-if "FM" in sys.argv:
-    use_fm = True
 
-client = jack.Client('VolcaFM')
-inport = client.midi_inports.register("in")
-outport = client.midi_outports.register("out")
+def xrun(delayed_usecs):
+    stats["xruns"] += 1
 
 # First 4 bits of status byte:
 NOTEON = 0x9
@@ -44,25 +66,293 @@ NOTEOFF = 0x8
 CC = 0xb0
 VEL = 41
 
-@client.set_process_callback
-def process(frames):
-    outport.clear_buffer()
-    for offset, indata in inport.incoming_midi_events():
-        if len(indata) == 3:
-            status, pitch, vel = struct.unpack("3B", indata)
-            if status >> 4 == NOTEON and use_fm:
-                outport.write_midi_event(offset, (CC, VEL, vel))
-                print("{} {} {} -> {} {} {}".format(status, pitch, vel, CC, VEL, vel))
-            if status >> 4 in (NOTEON, NOTEOFF):
-                outport.write_midi_event(offset, indata)
-
-client.activate()
-signal.signal(signal.SIGTERM, close)
-signal.signal(signal.SIGHUP, close)
-signal.signal(signal.SIGINT, close)
-
-print("Started drClass' MIDI Transcoder.")
-print("use_fm = {}".format(use_fm))
-print("Press [CTRL^C] to Stop.")
-while True:
-    time.sleep(10)
+
+class EventLog:
+    """
+    Single producer single consumer ring buffer of (status, pitch, vel, cc) entries. push() is called from the JACK
+    thread and only stores bytes in preallocated arrays, the head and tail stay below 256 so even the index updates
+    do not create int objects. A daemon thread prints the entries.
+    """
+    SIZE = 256
+
+    def __init__(self, interval=0.05):
+        self.status = array("B", bytes(self.SIZE))
+        self.pitch = array("B", bytes(self.SIZE))
+        self.vel = array("B", bytes(self.SIZE))
+        self.cc = array("B", bytes(self.SIZE))
+        self.head = 0  # written by push() only
+        self.tail = 0  # written by the log thread only
+        self.interval = interval
+
+    def push(self, status, pitch, vel, cc=VEL):
+        head = self.head
+        next_head = head + 1 if head < self.SIZE - 1 else 0
+        if next_head == self.tail:
+            stats["log_dropped"] += 1
+            return
+        self.status[head] = status
+        self.pitch[head] = pitch
+        self.vel[head] = vel
+        self.cc[head] = cc
+        self.head = next_head
+
+    def flush(self):
+        tail = self.tail
+        while tail != self.head:
+            vel = self.vel[tail]
+            print("{} {} {} -> {} {} {}".format(self.status[tail], self.pitch[tail], vel, CC, self.cc[tail], vel))
+            tail = tail + 1 if tail < self.SIZE - 1 else 0
+            self.tail = tail
+
+    def run(self):
+        while True:
+            self.flush()
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, name="EventLog", daemon=True).start()
+        return self
+
+
+# Pass-through policies for messages other than NOTE_ON/NOTE_OFF
+PASS_NOTES = "notes"  # drop everything else, the original behaviour
+PASS_CHANNEL = "channel"  # also pass CC, pitch bend, program change and aftertouch
+PASS_ALL = "all"  # also pass system messages, including system exclusive
+
+
+NO_CHORD = array("l", [-1] * 16)
+
+
+def quantize_table(quantize=None):
+    """
+    128 entry table mapping a velocity onto the velocity sent in the CC. quantize is a bucket width or a list of
+    ascending bucket values, a velocity maps onto the first bucket value at or above it.
+    """
+    if quantize is None:
+        return bytes(range(128))
+    if isinstance(quantize, int):
+        if quantize < 1:
+            raise ValueError("Velocity bucket width {} must be positive".format(quantize))
+        buckets = [min(v, 127) for v in range(quantize, 127 + quantize, quantize)]
+    else:
+        buckets = sorted(quantize)
+        if not buckets or not 0 < buckets[0] or buckets[-1] > 127:
+            raise ValueError("Velocity buckets {} must be in 1..127".format(quantize))
+    table = bytearray(128)
+    bucket = 0
+    for velocity in range(1, 128):
+        while bucket < len(buckets) - 1 and buckets[bucket] < velocity:
+            bucket += 1
+        table[velocity] = buckets[bucket]
+    return bytes(table)
+
+
+class PortPair:
+    """
+    One in/out port pair: NOTE_ON/NOTE_OFF on the channels in the channels bit mask are passed, preceded by a
+    velocity CC when inject is set. Other messages follow the pass_other policy.
+
+    With dedup the CC is skipped when the (quantized) velocity equals the last one sent on the channel, and a chord
+    (notes sharing a frame offset) gets a single CC ahead of all its notes.
+    """
+    def __init__(self, inport, outport, cc=VEL, channels=0xFFFF, pass_other=PASS_NOTES, inject=True, dedup=False,
+                 quantize=None):
+        if pass_other not in (PASS_NOTES, PASS_CHANNEL, PASS_ALL):
+            raise ValueError("Unknown pass-through policy {}".format(pass_other))
+        if not 0 <= cc < 128:
+            raise ValueError("Velocity CC {} out of range".format(cc))
+        self.inport = inport
+        self.outport = outport
+        self.cc = cc
+        self.channels = channels
+        self.pass_channel = pass_other in (PASS_CHANNEL, PASS_ALL)
+        self.pass_system = pass_other == PASS_ALL
+        self.inject = inject
+        self.velocity_cc = bytearray((CC, cc, 0))
+        self.dedup = dedup
+        self.velocity_table = quantize_table(quantize)
+        self.last_velocity = array("b", [-1] * 16)  # last velocity sent per channel
+        self.chord_offset = array("l", NO_CHORD)  # frame offset of the last CC per channel, this period
+
+    def reset(self):
+        """Forget the velocities sent, e.g. after the synth was reconnected. Not called from the process thread."""
+        self.last_velocity[:] = array("b", [-1] * 16)
+
+
+def channel_mask(channels):
+    """A list of channels (0-15) as a bit mask, None or a mask are passed as is."""
+    if channels is None:
+        return 0xFFFF
+    if isinstance(channels, int):
+        return channels
+    mask = 0
+    for channel in channels:
+        if not 0 <= channel < 16:
+            raise ValueError("Channel {} out of range".format(channel))
+        mask |= 1 << channel
+    return mask
+
+
+def load_config(path):
+    """
+    Read a JSON config:
+
+        {"client": "Volcas",
+         "ports": [{"in": "fm_in", "out": "fm_out", "cc": 41, "channels": [0], "pass": "channel"},
+                   {"in": "keys_in", "out": "keys_out", "cc": 41, "pass": "notes", "inject": false}]}
+
+    channels defaults to all channels, pass to "notes" and inject to true. Redundant velocity CCs are skipped when
+    "dedup" is true, "quantize" is a bucket width (e.g. 8) or a list of bucket values (e.g. [32, 64, 96, 127]).
+    """
+    with open(path) as f:
+        config = json.load(f)
+    if not config.get("ports"):
+        raise ValueError("{}: no ports configured".format(path))
+    return config
+
+
+def register_ports(client, config):
+    pairs = []
+    for port in config["ports"]:
+        inport = client.midi_inports.register(port["in"])
+        outport = client.midi_outports.register(port["out"])
+        pairs.append(PortPair(inport, outport, cc=port.get("cc", VEL), channels=channel_mask(port.get("channels")),
+                              pass_other=port.get("pass", PASS_NOTES), inject=port.get("inject", True),
+                              dedup=port.get("dedup", False), quantize=port.get("quantize")))
+    return pairs
+
+
+def make_server_process(pairs, log=None):
+    """
+    Return one JACK process callback walking all port pairs. Per event it only indexes preallocated bytearrays,
+    the injected velocity CC reuses one buffer per pair (JACK copies the event on write) and printing is left to
+    log, an EventLog, when given.
+    """
+    pairs = list(pairs)
+    # Scratch buffers per message length, slice assignment of equal length does not resize
+    scratch = (None, bytearray(1), bytearray(2), bytearray(3))
+
+    def process(frames):
+        start = time.perf_counter_ns()
+        events = unhandled = sent = skipped = 0
+        for pair in pairs:
+            outport = pair.outport
+            outport.clear_buffer()
+            if pair.dedup:
+                pair.chord_offset[:] = NO_CHORD
+            for offset, indata in pair.inport.incoming_midi_events():
+                events += 1
+                length = len(indata)
+                if length > 3:  # system exclusive
+                    if pair.pass_system:
+                        outport.write_midi_event(offset, indata)
+                    else:
+                        unhandled += 1
+                    continue
+                event = scratch[length]
+                event[:] = indata
+                status = event[0]
+                if status >= 0xF0:
+                    if pair.pass_system:
+                        outport.write_midi_event(offset, event)
+                    else:
+                        unhandled += 1
+                    continue
+                if not pair.channels >> (status & 0x0F) & 1:
+                    unhandled += 1
+                    continue
+                command = status >> 4
+                if command == NOTEON and length == 3:
+                    if pair.inject and event[2]:
+                        channel = status & 0x0F
+                        velocity = pair.velocity_table[event[2]]
+                        if pair.dedup and (pair.chord_offset[channel] == offset or
+                                           pair.last_velocity[channel] == velocity):
+                            skipped += 1
+                        else:
+                            velocity_cc = pair.velocity_cc
+                            velocity_cc[0] = CC | channel
+                            velocity_cc[2] = velocity
+                            outport.write_midi_event(offset, velocity_cc)
+                            pair.last_velocity[channel] = velocity
+                            sent += 1
+                            if log is not None:
+                                log.push(status, event[1], velocity, pair.cc)
+                        pair.chord_offset[channel] = offset
+                    outport.write_midi_event(offset, event)
+                elif command == NOTEOFF or pair.pass_channel:
+                    if command == 0xB and event[1] == pair.cc:  # the velocity CC sent by someone else
+                        pair.last_velocity[status & 0x0F] = event[2]
+                    outport.write_midi_event(offset, event)
+                else:
+                    unhandled += 1
+        # The counters are updated once per period instead of per event
+        stats["events"] += events
+        if unhandled:
+            stats["unhandled"] += unhandled
+        if sent:
+            stats["ccs_sent"] += sent
+        if skipped:
+            stats["ccs_skipped"] += skipped
+            stats["bytes_saved"] += 3 * skipped
+        elapsed = time.perf_counter_ns() - start
+        durations[min(elapsed.bit_length(), 39)] += 1
+        stats["callbacks"] += 1
+        if elapsed > stats["max_ns"]:
+            stats["max_ns"] = elapsed
+    return process
+
+
+def make_port_connect(pairs):
+    """
+    Return a JACK port connect callback resetting the pairs whose out port gets connected, a synth connected again
+    may have lost the velocity it was sent, so the next note sends the CC again.
+    """
+    pairs = list(pairs)
+
+    def port_connect(a, b, connect):
+        if connect:
+            for pair in pairs:
+                if pair.outport in (a, b):
+                    pair.reset()
+    return port_connect
+
+
+def make_process(inport, outport, use_fm, log=None):
+    """The original single pair callback: notes on all channels, CC 41 injected when use_fm."""
+    return make_server_process([PortPair(inport, outport, inject=use_fm)], log)
+
+
+if __name__ == "__main__":
+    if "--config" in sys.argv:
+        config = load_config(sys.argv[sys.argv.index("--config") + 1])
+    else:
+        use_fm = "FM" in sys.argv
+        config = {"client": "VolcaFM", "ports": [{"in": "in", "out": "out", "inject": use_fm,
+                                                  "dedup": "--dedup" in sys.argv}]}
+    log = EventLog().start() if "-q" not in sys.argv else None
+
+    client = jack.Client(config.get("client", "VolcaFM"))
+    pairs = register_ports(client, config)
+    client.set_process_callback(make_server_process(pairs, log))
+    client.set_xrun_callback(xrun)
+    client.set_port_connect_callback(make_port_connect(pairs))
+
+    client.activate()
+    signal.signal(signal.SIGTERM, close)
+    signal.signal(signal.SIGHUP, close)
+    signal.signal(signal.SIGINT, close)
+    signal.signal(signal.SIGUSR1, report)
+
+    def reset(code, frame):
+        for pair in pairs:
+            pair.reset()
+    signal.signal(signal.SIGUSR2, reset)
+
+    print("Started drClass' MIDI Transcoder.")
+    for pair in pairs:
+        print("{} -> {}: cc = {} inject = {}".format(pair.inport.name, pair.outport.name, pair.cc, pair.inject))
+    print("Press [CTRL^C] to Stop, send SIGUSR1 for statistics, SIGUSR2 to send every velocity CC again. "
+          "Pass -q to not print the notes.")
+    while True:
+        time.sleep(10)